@@ -0,0 +1,309 @@
+''' front end throughput benchmark: generates Pascal sources of a given
+scale and times Tokenizer.tokenize() and a parser's run() on them.
+
+    python bench.py [--scale N] [--repeat N] [--parser NAME]
+                    [--output FILE] [CORPUS...]
+
+Prints (or writes to FILE) a JSON report with tokens/s, MB/s, AST
+nodes/s and peak RSS for every corpus and phase, and the bytes the tree
+takes as Node objects and as an AstArena for the parse phase. The parse
+phase uses the --parser given, else each corpus' own (StackParser for
+the deep one, which nests too deep for Parser to recurse) '''
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from calculator import (AstArena, LL1Parser, Node, Parser, StackParser,
+                        Tokenizer)
+
+
+REPORT_VERSION = 3
+PHASES = ['tokenize', 'parse']
+
+# begin/end levels of the nested corpus at most. Parser recurses a few
+# frames per level, deeper sources need a bigger recursion limit (or the
+# deep corpus' StackParser)
+NESTING_DEPTH = 50
+
+STATEMENTS = [
+    'x := (x + 12) * y - 3 / 2',
+    'if x > 3 then print(x) else print(y - x)',
+    'while x < 10 do begin x := x + 1; y := y * 2 end',
+    'b := not (x = y) and (x > 0 or y < 100)',
+    'print(x * y + 7)',
+]
+
+
+def program(var_lines, statements):
+    return 'program bench;\nvar {}\nbegin\n    {}\nend.\n'.format(
+        ';\n    '.join(['x, y: integer', 'b: boolean'] + var_lines),
+        ';\n    '.join(statements))
+
+
+def statements_corpus(scale, rand):
+    ''' one long statement list '''
+    return program([], [rand.choice(STATEMENTS) for _ in range(scale)])
+
+
+def nest(depth, rand):
+    ''' statements nested depth deep: begin blocks, whiles and ifs with a
+    statement a level, around an expression in depth parenthesis '''
+    opens = []
+    closes = []
+    for level in range(depth):
+        head, tail = [
+            ('begin {}; ', ' end'),
+            ('while x < 10 do begin {}; ', ' end'),
+            ('if x > 3 then begin {}; ', ' end else print(x)'),
+        ][level % 3]
+        opens.append(head.format(rand.choice(STATEMENTS)))
+        closes.append(tail)
+    return '{}x := {}x{}{}'.format(''.join(opens), '(1 + ' * depth,
+                                   ')' * depth, ''.join(reversed(closes)))
+
+
+def nesting_corpus(scale, rand):
+    ''' nests about the square root of scale deep, up to NESTING_DEPTH,
+    Parser can still recurse through them '''
+    depth = max(1, min(NESTING_DEPTH, int(scale ** 0.5)))
+    return program([], [nest(depth, rand)
+                        for _ in range(max(1, scale // depth))])
+
+
+def deep_corpus(scale, rand):
+    ''' a single nest scale levels deep '''
+    return program([], [nest(scale, rand)])
+
+
+def name(index):
+    ''' distinct identifier for an index (identifiers cannot hold digits),
+    no reserved word starts with z '''
+    letters = []
+    while True:
+        index, letter = divmod(index, 26)
+        letters.append(chr(ord('a') + letter))
+        if not index:
+            return 'z' + ''.join(letters)
+
+
+def vars_corpus(scale, rand):
+    ''' a wide var section and a short body '''
+    var_lines = ['{}, {}: {}'.format(name(2 * i), name(2 * i + 1),
+                                     rand.choice(['integer', 'boolean']))
+                 for i in range(scale)]
+    return program(var_lines, STATEMENTS)
+
+
+def comments_corpus(scale, rand):
+    ''' mostly comments, a short one on every statement and long ones
+    spanning several lines in between '''
+    words = ['lorem', 'ipsum', 'begin', 'end', ':=', 'x', '42', ';', '\n']
+    statements = []
+    for _ in range(scale):
+        statement = '{{ {} }} {}'.format(rand.choice(words),
+                                         rand.choice(STATEMENTS))
+        if rand.random() < 0.2:
+            comment = ' '.join(rand.choice(words) for _ in range(60))
+            statement = '{{ {} }}\n    {}'.format(comment, statement)
+        statements.append(statement)
+    return program([], statements)
+
+
+def functions_corpus(scale, rand):
+    ''' many top level functions of a few statements and a short body,
+    what lazy bodies and parallel parsing are for '''
+    funcs = ['function {0}(n: integer): integer;\nvar x, y: integer; '
+             'b: boolean\nbegin\n    {1};\n    {0} := n\nend;\n'.format(
+                 name(i), ';\n    '.join(rand.choice(STATEMENTS)
+                                         for _ in range(5)))
+             for i in range(max(1, scale // 5))]
+    return program([], STATEMENTS).replace(
+        '\nbegin', '\n' + ''.join(funcs) + 'begin', 1)
+
+
+def expressions_corpus(scale, rand):
+    ''' a few very long expressions '''
+    statements = []
+    for _ in range(max(1, scale // 200)):
+        terms = ['x']
+        for _ in range(200):
+            term = rand.choice(['x', 'y', '12', '(x - 3)', '(y * 2 + 1)'])
+            terms.append(rand.choice(['+', '-', '*', '/']))
+            terms.append(term)
+        statements.append('x := ' + ' '.join(terms))
+    return program([], statements)
+
+
+CORPORA = {
+    'statements': statements_corpus,
+    'nesting': nesting_corpus,
+    'deep': deep_corpus,
+    'vars': vars_corpus,
+    'comments': comments_corpus,
+    'functions': functions_corpus,
+    'expressions': expressions_corpus,
+}
+
+
+def parse_lazy(src):
+    ''' the tree with its function bodies left to parse '''
+    return Parser(src, lazy_functions=True).run()
+
+
+def parse_parallel(src):
+    ''' the tree with the top level functions parsed in a process pool,
+    lexing included '''
+    return Parser(src, Tokenizer(src).tokenize().cursor()).run_parallel()
+
+
+# callables from a source to its tree, by --parser name
+PARSERS = {
+    'parser': lambda src: Parser(src).run(),
+    'stack': lambda src: StackParser(src).run(),
+    'll1': lambda src: LL1Parser(src).run(),
+    'lazy': parse_lazy,
+    'parallel': parse_parallel,
+}
+# the parser of a corpus when --parser is not given
+CORPUS_PARSERS = {'deep': 'stack'}
+
+
+def count_nodes(tree):
+    count = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Node):
+            count += 1
+            if node.children:
+                stack.extend(node.children)
+        elif isinstance(node, list):
+            stack.extend(node)
+    return count
+
+
+def ast_memory(parse, src):
+    ''' bytes allocated for the tree of src, lazy bodies forced, then for
+    the same tree in an AstArena once the tree is gone '''
+    tracemalloc.start()
+    try:
+        tree = parse(src)
+        count_nodes(tree)
+        ast_bytes = tracemalloc.get_traced_memory()[0]
+        arena = AstArena()
+        arena.add_tree(tree)
+        del tree
+        arena_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del arena
+    return ast_bytes, arena_bytes
+
+
+def peak_rss():
+    ''' peak resident set size of this process, in bytes '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(corpus, phase, scale, repeat, parser):
+    ''' runs in a fresh process, so peak RSS only covers this case '''
+    src = CORPORA[corpus](scale, random.Random(scale))
+    parse = PARSERS[parser]
+    tokens = len(Tokenizer(src).tokenize())
+    base_rss = peak_rss()
+
+    best = None
+    nodes = None
+    for _ in range(repeat):
+        if phase == 'tokenize':
+            start = time.perf_counter()
+            Tokenizer(src).tokenize()
+            elapsed = time.perf_counter() - start
+        else:
+            start = time.perf_counter()
+            tree = parse(src)
+            elapsed = time.perf_counter() - start
+            nodes = count_nodes(tree)
+            del tree
+        best = elapsed if best is None else min(best, elapsed)
+
+    size = len(src.encode())
+    peak = peak_rss()
+    result = {
+        'corpus': corpus,
+        'phase': phase,
+        'parser': parser,
+        'bytes': size,
+        'tokens': tokens,
+        'seconds': best,
+        'tokens_per_second': tokens / best,
+        'mb_per_second': size / best / 1e6,
+        'peak_rss_bytes': peak,
+        'base_rss_bytes': base_rss,
+    }
+    if nodes is not None:
+        result['ast_nodes'] = nodes
+        result['ast_nodes_per_second'] = nodes / best
+        result['ast_bytes'], result['arena_bytes'] = ast_memory(parse, src)
+    return result
+
+
+def run(corpora, scale, repeat, parser=None):
+    ''' parser is a PARSERS name, None for each corpus' own '''
+    results = []
+    for corpus in corpora:
+        corpus_parser = parser or CORPUS_PARSERS.get(corpus, 'parser')
+        for phase in PHASES:
+            with ProcessPoolExecutor(1) as pool:
+                future = pool.submit(run_case, corpus, phase, scale, repeat,
+                                     corpus_parser)
+                try:
+                    results.append(future.result())
+                except (ValueError, RecursionError) as err:
+                    results.append({'corpus': corpus, 'phase': phase,
+                                    'parser': corpus_parser,
+                                    'error': str(err)})
+    return {
+        'version': REPORT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('corpora', nargs='*', metavar='CORPUS',
+                            help='one of {} (default: all)'
+                            .format(', '.join(CORPORA)))
+    arg_parser.add_argument('--scale', type=int, default=20000,
+                            help='statements (or declarations) per corpus')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='runs per case, the best one is reported')
+    arg_parser.add_argument('--parser', choices=list(PARSERS),
+                            help='parser of the parse phase (default: the '
+                            'corpus\' own)')
+    arg_parser.add_argument('--output', help='JSON report file')
+    args = arg_parser.parse_args()
+    for corpus in args.corpora:
+        if corpus not in CORPORA:
+            arg_parser.error('unknown corpus {}'.format(corpus))
+
+    report = run(args.corpora or list(CORPORA), args.scale, args.repeat,
+                 args.parser)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
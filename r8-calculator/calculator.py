@@ -1,5 +1,18 @@
+import gc
+import hashlib
+import mmap
+import os
+import re
+import struct
 import sys
-from random import randint
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import accumulate, chain, compress
+from operator import add
 
 
 DIV = '/'
@@ -41,49 +54,106 @@ CLOSE_COMMENT = '}'
 INTEGER_TYPE = 'integer'
 BOOLEAN_TYPE = 'boolean'
 
-NUM = 'int'
 VAR = 'var'
 RWORD = 'rword'
 STD_FILE_NAME = 'test.pas'
-
-SIGNS = [PLUS, MINUS, NOT]
-COMPARISON = [GT, LT, EQUALS]
-TERMINATORS = [END, DOT]
-CONDITIONALS = [IF, ELSE]
-
-
-class Token:
-    operators = []
-
-    def __init__(self, type_, value):
-        self.type_ = type_
-        self.value = value
-
-
-class Term(Token):
-    operators = [MULT, DIV, AND]
-
-
-class Num(Token):
-    operators = []
-
-
-class Expr(Token):
-    operators = [PLUS, MINUS, OR]
-
-
-class Parent(Token):
-    operators = [OPEN_PARENT, CLOSE_PARENT]
-
-
-class Word(Token):
-    pass
-
-
-class RWord(Token):
-    operators = [ASSIGNER, BEGIN, END, DOUBLE_DOTS,
-                 SEMICOLON, PRINT, READ, AND, NOT, OR,
-                 IF, THEN, DO, WHILE, DOT, COMMA, ELSE]
+# bump when parsing or the AST changes, it keys the parse cache
+COMPILER_VERSION = '8.2'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'r8-calculator')
+MMAP_FLAG = '--mmap'
+PARALLEL_FLAG = '--parallel'
+STACK_FLAG = '--stack'
+TRACE_FLAG = '--trace'
+ARENA_FLAG = '--arena'
+HASH_CONS_FLAG = '--hash-cons'
+CACHE_FLAG = '--cache'
+LAZY_FLAG = '--lazy'
+RECOVER_FLAG = '--recover'
+LL1_FLAG = '--ll1'
+FLAGS = [MMAP_FLAG, PARALLEL_FLAG, STACK_FLAG, TRACE_FLAG, ARENA_FLAG,
+         HASH_CONS_FLAG, CACHE_FLAG, LAZY_FLAG, RECOVER_FLAG, LL1_FLAG]
+
+# token kinds, as stored in the tokenizer's token buffer
+TK_EOF = 0
+TK_NUM = 1
+TK_IDENTIFIER = 2
+TK_PLUS = 3
+TK_MINUS = 4
+TK_MULT = 5
+TK_DIV = 6
+TK_GT = 7
+TK_LT = 8
+TK_EQUALS = 9
+TK_OPEN_PARENT = 10
+TK_CLOSE_PARENT = 11
+TK_SEMICOLON = 12
+TK_COMMA = 13
+TK_DOT = 14
+TK_DOUBLE_DOTS = 15
+TK_ASSIGNER = 16
+TK_PROGRAM = 17
+TK_VAR = 18
+TK_FUNCTION = 19
+TK_INTEGER = 20
+TK_BOOLEAN = 21
+TK_BEGIN = 22
+TK_END = 23
+TK_PRINT = 24
+TK_READ = 25
+TK_AND = 26
+TK_OR = 27
+TK_NOT = 28
+TK_IF = 29
+TK_THEN = 30
+TK_ELSE = 31
+TK_WHILE = 32
+TK_DO = 33
+
+# fixed text of each token kind (indexed by kind)
+TOKEN_TEXTS = [
+    None, None, None,  # end of file, numbers and identifiers
+    PLUS, MINUS, MULT, DIV, GT, LT, EQUALS, OPEN_PARENT, CLOSE_PARENT,
+    SEMICOLON, COMMA, DOT, DOUBLE_DOTS, ASSIGNER,
+    PROGRAM, VAR, FUNCTION, INTEGER_TYPE, BOOLEAN_TYPE,
+    BEGIN, END, PRINT, READ, AND, OR, NOT, IF, THEN, ELSE, WHILE, DO,
+]
+TOKEN_KINDS = {text: kind for kind, text in enumerate(TOKEN_TEXTS)
+               if text is not None}
+
+TERM_KINDS = frozenset([TK_MULT, TK_DIV, TK_AND])
+EXPR_KINDS = frozenset([TK_PLUS, TK_MINUS, TK_OR])
+COMPARISON_KINDS = frozenset([TK_GT, TK_LT, TK_EQUALS])
+TERMINATOR_KINDS = frozenset([TK_END, TK_DOT])
+TYPE_KINDS = frozenset([TK_INTEGER, TK_BOOLEAN])
+RESERVED_KINDS = frozenset(range(TK_PROGRAM, TK_DO + 1))
+UNARY_KINDS = frozenset([TK_PLUS, TK_MINUS, TK_NOT])
+# panic mode error recovery skips to one of these after a syntax error
+SYNC_KINDS = frozenset([TK_SEMICOLON, TK_END, TK_BEGIN, TK_FUNCTION, TK_DOT,
+                        TK_EOF])
+# the parameters of a function header are split by ;, a broken header is
+# skipped up to the body instead
+HEADER_SYNC_KINDS = frozenset([TK_VAR, TK_BEGIN, TK_FUNCTION, TK_DOT, TK_EOF])
+
+# binding power of each binary operator kind (0 for other tokens)
+BINARY_PRECEDENCE = [
+    1 if kind in COMPARISON_KINDS else
+    2 if kind in EXPR_KINDS else
+    3 if kind in TERM_KINDS else 0
+    for kind in range(len(TOKEN_TEXTS))
+]
+MAX_PRECEDENCE = 3
+UNARY_PRECEDENCE = MAX_PRECEDENCE + 1
+
+# one token: numbers, words, := and single char punctuation. Any other non
+# blank char is captured too, so it can be reported
+MASTER_PATTERN = r'''
+    ( \d+
+    | [^\W\d]+
+    | :=
+    | [-+*/<>=(),;.:]
+    | \S
+    )
+'''
 
 
 class Variable:
@@ -140,67 +210,220 @@ def variable_factory(type_, value=None):
         )
 
 
-class SymbolTable:
+class NameTable:
+    ''' interns the identifiers of a compilation, each distinct name is
+    stored once and gets a small int id (its index in self.names) '''
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def intern(self, name):
+        id_ = self.ids.get(name)
+        if id_ is None:
+            id_ = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return id_
+
+    def __getitem__(self, id_):
+        return self.names[id_]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ConstantPool:
+    ''' numeric literals of a compilation, each distinct value is stored
+    once and number tokens refer to it by index (in self.values) '''
+
     def __init__(self):
-        self.table = {}
+        self.values = []
+        self.ids = {}
+
+    def add(self, value):
+        id_ = self.ids.get(value)
+        if id_ is None:
+            id_ = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return id_
+
+    def __getitem__(self, id_):
+        return self.values[id_]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class SymbolTable:
+    ''' variables indexed by the name ids handed out by a NameTable '''
+
+    def __init__(self, names=None):
+        self.names = names
+        self.table = []
+
+    def name_of(self, identifier):
+        if self.names is None:
+            return '#{}'.format(identifier)
+        return self.names[identifier]
 
     def add_identifier(self, identifier, value):
-        if identifier in self.table:
+        if identifier >= len(self.table):
+            self.table.extend([None] * (identifier + 1 - len(self.table)))
+        elif self.table[identifier] is not None:
             print('[WARN] identifier already in symbol table, overriding it')
         self.table[identifier] = value
 
     def set_identifier(self, identifier, value):
         ''' value is a variable type '''
-        if identifier not in self.table:
-            raise ValueError('Undefined variable {}'.format(identifier))
-        self.table[identifier].set_value(value)
+        variable = self._lookup(identifier)
+        if variable is None:
+            raise ValueError('Undefined variable {}'
+                             .format(self.name_of(identifier)))
+        variable.set_value(value)
 
     def get_identifier(self, identifier):
-        if identifier not in self.table:
+        variable = self._lookup(identifier)
+        if variable is None:
             raise ValueError('Identifier {} not in symbol table'
-                             .format(identifier))
-        return self.table[identifier].value
+                             .format(self.name_of(identifier)))
+        return variable.value
+
+    def _lookup(self, identifier):
+        try:
+            return self.table[identifier]
+        except IndexError:
+            return None
 
     def clear(self):
-        self.table = {}
+        self.table = []
+
+
+# children of every leaf node
+NO_CHILDREN = ()
+# a node span packs the start and end offsets of its source text in one
+# int, start << SPAN_SHIFT | end. That int is an object of its own next
+# to the slot, about 40 bytes a node, which no per node int can make
+# smaller; an AstArena keeps spans in an array('q') column, 8 bytes a node
+SPAN_SHIFT = 32
+SPAN_MASK = (1 << SPAN_SHIFT) - 1
 
 
 class Node:
-    def __init__(self, value, children):
+    ''' AST node, children is a tuple of nodes (or of plain values, e.g.
+    the name id and type of a variable declaration). span is where the
+    node is in the source (see span_of), None for the nodes the parser
+    makes up, e.g. the NoOp of an if without else '''
+    __slots__ = ('value', 'children', 'span')
+
+    def __init__(self, value, children=NO_CHILDREN, span=None):
         self.value = value
-        self.children = children
+        self.children = tuple(children) if children else NO_CHILDREN
+        self.span = span
 
     def evaluate(self, symbol_table):
         pass
 
 
+def span_of(node):
+    ''' (start, end) source offsets of a node, None if it has no span. A
+    node shared by several parents (a literal, a hash consed expression)
+    has the span of the first of its occurrences parsed, which depends on
+    the parse order: lazy function bodies and parallel batches are parsed
+    out of order, and IncrementalParser reparses units. Only the spans of
+    unshared nodes are reliable '''
+    span = node.span
+    if span is None:
+        return None
+    return span >> SPAN_SHIFT, span & SPAN_MASK
+
+
+def covering(nodes):
+    ''' span from the start of the first of nodes with a span to the end
+    of the last one, None if none has one '''
+    spans = [node.span for node in nodes if node.span is not None]
+    if not spans:
+        return None
+    return spans[0] & ~SPAN_MASK | spans[-1] & SPAN_MASK
+
+
+def located(err, node, statement=False):
+    ''' err raised while evaluating node, which is kept in err.node for
+    the error to be reported with the node's location (only the
+    innermost node is kept). The innermost statement it goes through is
+    kept in err.statement: with hash consing err.node can be shared by
+    several statements and have the span of another one (see span_of),
+    a statement is never shared '''
+    if getattr(err, 'node', None) is None:
+        err.node = node
+    if statement and getattr(err, 'statement', None) is None:
+        err.statement = node
+    return err
+
+
 class Program(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         for child in self.children:
             child.evaluate(symbol_table)
 
 
 class VarBlock(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         for child in self.children:
             child.evaluate(symbol_table)
 
 
 class FuncBlock(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         for child in self.children:
             child.evaluate(symbol_table)
 
 
 class FuncDec(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
        pass
 
 
+class LazyFuncDec(FuncDec):
+    ''' FuncDec whose children are only built (by calling parse) the first
+    time they are read, see Parser(lazy_functions=True) '''
+    __slots__ = ('parse', 'parsed')
+
+    def __init__(self, value, parse, span=None):
+        self.value = value
+        self.parse = parse
+        self.parsed = None
+        self.span = span
+
+    @property
+    def children(self):
+        if self.parse is not None:
+            self.parsed = self.parse()
+            self.parse = None
+        return self.parsed
+
+    @children.setter
+    def children(self, children):
+        self.parse = None
+        self.parsed = children
+
+
 class TriOp(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         if self.value == IF:
-            self.eval_if(symbol_table)
+            try:
+                self.eval_if(symbol_table)
+            except ValueError as err:
+                raise located(err, self, statement=True)
 
     def eval_if(self, st):
         return self.children[1 if self.children[0].evaluate(st)
@@ -208,470 +431,1763 @@ class TriOp(Node):
 
 
 class Statements(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         for child in self.children:
             child.evaluate(symbol_table)
 
 
 class BinOp(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
+        value = self.value
+        children = self.children
         # this if is unnecessary
-        if len(self.children) != 2:
+        if len(children) != 2:
             raise ValueError('Unexpected children len for node, expected 2,\
-            got {}'.format(len(self.children)))
-        if self.value == ASSIGNER:
-            symbol_table.set_identifier(self.children[0].value,
-                                        self.children[1].evaluate(
-                                            symbol_table))
+            got {}'.format(len(children)))
+        if value == ASSIGNER:
+            try:
+                result = children[1].evaluate(symbol_table)
+                symbol_table.set_identifier(children[0].value, result)
+            except ValueError as err:
+                raise located(err, self, statement=True)
             return None
-        elif self.value == WHILE:
-            return self.eval_while(symbol_table)
-        elif self.value == DOUBLE_DOTS:  # variable declarations
-            symbol_table.add_identifier(self.children[0],
-                                        variable_factory(self.children[1],
-                                                         None))
+        elif value == WHILE:
+            try:
+                return self.eval_while(symbol_table)
+            except ValueError as err:
+                raise located(err, self, statement=True)
+        elif value == DOUBLE_DOTS:  # variable declarations
+            symbol_table.add_identifier(children[0],
+                                        variable_factory(children[1], None))
             return
 
-        children_values = [c.evaluate(symbol_table) for c in self.children]
-        if self.value == PLUS:
-            return children_values[0] + children_values[1]
-        elif self.value == MINUS:
-            return children_values[0] - children_values[1]
-        elif self.value == DIV:
-            return children_values[0] // children_values[1]
-        elif self.value == MULT:
-            return children_values[0] * children_values[1]
-        elif self.value == OR:
-            return children_values[0] or children_values[1]
-        elif self.value == AND:
-            return children_values[0] and children_values[1]
-        elif self.value == LT:
-            return children_values[0] < children_values[1]
-        elif self.value == GT:
-            return children_values[0] > children_values[1]
-        elif self.value == EQUALS:
-            return children_values[0] == children_values[1]
+        left = children[0].evaluate(symbol_table)
+        right = children[1].evaluate(symbol_table)
+        if value == PLUS:
+            return left + right
+        elif value == MINUS:
+            return left - right
+        elif value == DIV:
+            return left // right
+        elif value == MULT:
+            return left * right
+        elif value == OR:
+            return left or right
+        elif value == AND:
+            return left and right
+        elif value == LT:
+            return left < right
+        elif value == GT:
+            return left > right
+        elif value == EQUALS:
+            return left == right
         else:  # this should NEVER happen!
-            raise ValueError('Unexpected value for BinOp, got', self.value)
+            raise ValueError('Unexpected value for BinOp, got', value)
 
     def eval_while(self, st):
-        expr = self.children[0]
-        stmt = self.children[1]
+        expr, stmt = self.children
         while expr.evaluate(st):
             stmt.evaluate(st)
 
 
 class ReadOp(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
         return int(input())
 
 
 class UnOp(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
+        value = self.value
+        children = self.children
         # this if is unnecessary
-        if len(self.children) != 1:
+        if len(children) != 1:
             raise ValueError('Unexpected children len for node, expected 1, \
-            got {}'.format(len(self.children)))
-        # print('UnOp#evaluate', self.value, self.children)
-        child_value = self.children[0].evaluate(symbol_table)
-        if self.value == PLUS:
+            got {}'.format(len(children)))
+        if value == PRINT:
+            try:
+                print(children[0].evaluate(symbol_table))
+            except ValueError as err:
+                raise located(err, self, statement=True)
+            return None
+        child_value = children[0].evaluate(symbol_table)
+        if value == PLUS:
             return child_value
-        elif self.value == MINUS:
+        elif value == MINUS:
             return -child_value
-        elif self.value == PRINT:
-            print(child_value)
-            return None
-        elif self.value == NOT:
+        elif value == NOT:
             return not child_value
         else:
             raise ValueError('Unexpected value for UnOp, got {}'
-                             .format(self.value))
+                             .format(value))
 
 
 class IntVal(Node):
+    ''' integer literal, constant is the index of its value in the
+    compilation's ConstantPool '''
+
+    __slots__ = ('constant',)
+
+    def __init__(self, value, children=NO_CHILDREN, constant=None,
+                 span=None):
+        super().__init__(value, children, span)
+        self.constant = constant
+
     def evaluate(self, symbol_table):
         return self.value
 
 
 class Identifier(Node):
+    __slots__ = ()
+
     def evaluate(self, symbol_table):
-        return symbol_table.get_identifier(self.value)
+        try:
+            return symbol_table.get_identifier(self.value)
+        except ValueError as err:
+            raise located(err, self)
 
 
 class NoOp(Node):
-    pass
+    __slots__ = ()
+
+
+# node classes by kind, as stored in an AstArena
+NODE_CLASSES = [
+    Program, VarBlock, FuncBlock, FuncDec, TriOp, Statements, BinOp, ReadOp,
+    UnOp, IntVal, Identifier, NoOp,
+]
+
+
+class NodeView(Node):
+    ''' node of an AstArena seen as a Node, value and children are read
+    from the arena columns on access. Each node class has its view class
+    (a subclass of both), so evaluate and isinstance work as for Nodes '''
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+
+    @property
+    def value(self):
+        return self.arena.atoms[self.arena.values[self.index]]
+
+    @property
+    def children(self):
+        return self.arena.children_of(self.index)
+
+    @property
+    def constant(self):
+        constant = self.arena.constants[self.index]
+        return None if constant < 0 else constant
+
+    @property
+    def span(self):
+        span = self.arena.spans[self.index]
+        return None if span < 0 else span
+
+
+VIEW_CLASSES = [type(node_class.__name__ + 'View', (NodeView, node_class), {})
+                for node_class in NODE_CLASSES]
+NODE_KINDS = {node_class: kind for kind, node_class in enumerate(NODE_CLASSES)}
+NODE_KINDS.update((view_class, kind)
+                  for kind, view_class in enumerate(VIEW_CLASSES))
+# a lazy function is stored parsed, as the FuncDec it stands for
+NODE_KINDS[LazyFuncDec] = NODE_KINDS[FuncDec]
+
+# AstArena.tobytes() header: magic, byte order, then the size of each part
+ARENA_MAGIC = b'r8ast\x00\x00\x03'
+ARENA_HEADER = struct.Struct('<8s?6I')
+# ParseCache entry header: size of the names text
+CACHE_HEADER = struct.Struct('<I')
+# atom types
+ATOM_NONE = 0
+ATOM_INT = 1
+ATOM_STR = 2
+# an int too big for the int column, stored as decimal text
+ATOM_BIG_INT = 3
+# range of the int column
+ATOM_INT_MIN = -1 << 63
+ATOM_INT_MAX = (1 << 63) - 1
+
+
+class AstArena:
+    ''' append only AST storage in parallel columns instead of Node objects.
+    Node i is a NODE_CLASSES[kinds[i]] with value atoms[values[i]] (atoms
+    holds each distinct value once), IntVal constant constants[i] (-1 for
+    none), span spans[i] (-1 for none) and children
+    edges[firsts[i]:firsts[i + 1]] (up to len(edges) for the last node).
+    An edge is the index of a child node, or -1 - the atom of a child that
+    is a plain value (e.g. a declared type).
+
+    Children are added before their parents, so the root is the last node
+    and shared subtrees are stored once. view() gives Node-like views '''
 
+    def __init__(self):
+        self.kinds = array('i')
+        self.values = array('i')
+        self.constants = array('i')
+        self.spans = array('q')
+        self.firsts = array('i')
+        self.edges = array('i')
+        self.atoms = []
+        self.atom_ids = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def atom(self, value):
+        id_ = self.atom_ids.get(value)
+        if id_ is None:
+            id_ = self.atom_ids[value] = len(self.atoms)
+            self.atoms.append(value)
+        return id_
+
+    def add(self, node_class, value, edges=NO_CHILDREN, constant=None,
+            span=None):
+        ''' appends a node and returns its index, edges are encoded as
+        described in the class docstring '''
+        self.kinds.append(NODE_KINDS[node_class])
+        self.values.append(self.atom(value))
+        self.constants.append(-1 if constant is None else constant)
+        self.spans.append(-1 if span is None else span)
+        self.firsts.append(len(self.edges))
+        self.edges.extend(edges)
+        return len(self.kinds) - 1
+
+    def add_tree(self, root):
+        ''' appends a Node tree, children first, and returns the index of
+        its root. Walks an explicit stack, so deep trees are fine: a node
+        stays on it until all of its children have an index '''
+        indexes = {}
+        atom = self.atom
+        edges = self.edges
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            if id(node) in indexes:
+                stack.pop()
+                continue
+            pending = [child for child in node.children
+                       if isinstance(child, Node) and id(child) not in indexes]
+            if pending:
+                stack.extend(reversed(pending))
+                continue
+            stack.pop()
+            indexes[id(node)] = len(self.kinds)
+            self.kinds.append(NODE_KINDS[type(node)])
+            self.values.append(atom(node.value))
+            constant = getattr(node, 'constant', None)
+            self.constants.append(-1 if constant is None else constant)
+            self.spans.append(-1 if node.span is None else node.span)
+            self.firsts.append(len(edges))
+            edges.extend([indexes[id(child)] if isinstance(child, Node)
+                          else -1 - atom(child) for child in node.children])
+        return indexes[id(root)]
+
+    def view(self, index=-1):
+        ''' view of a node, the root (last node) by default '''
+        if index < 0:
+            index += len(self.kinds)
+        return VIEW_CLASSES[self.kinds[index]](self, index)
+
+    def children_of(self, index):
+        first = self.firsts[index]
+        if index + 1 < len(self.firsts):
+            end = self.firsts[index + 1]
+        else:
+            end = len(self.edges)
+        if first == end:
+            return NO_CHILDREN
+        return tuple(self.view(edge) if edge >= 0 else self.atoms[-1 - edge]
+                     for edge in self.edges[first:end])
+
+    def tobytes(self):
+        ''' the whole arena as bytes: a header, the columns, then the atoms
+        as a type column, an int column and the utf-8 text of the str ones
+        (and of the ints out of the int column's range) with their lengths.
+        Columns keep the machine's byte order, which is recorded in the
+        header '''
+        atom_types = array('b')
+        ints = array('q')
+        lengths = array('i')
+        texts = []
+        for atom in self.atoms:
+            if atom is None:
+                atom_types.append(ATOM_NONE)
+            elif isinstance(atom, int) and (ATOM_INT_MIN <= atom <=
+                                            ATOM_INT_MAX):
+                atom_types.append(ATOM_INT)
+                ints.append(atom)
+            elif isinstance(atom, (int, str)):
+                text = str(atom).encode()
+                atom_types.append(ATOM_STR if isinstance(atom, str)
+                                  else ATOM_BIG_INT)
+                lengths.append(len(text))
+                texts.append(text)
+            else:
+                raise ValueError('Unsupported AST value {!r}'.format(atom))
+        text = b''.join(texts)
+        header = ARENA_HEADER.pack(ARENA_MAGIC, sys.byteorder == 'little',
+                                   len(self.kinds), len(self.edges),
+                                   len(atom_types), len(ints), len(lengths),
+                                   len(text))
+        return b''.join([header, self.kinds.tobytes(), self.values.tobytes(),
+                         self.constants.tobytes(), self.spans.tobytes(),
+                         self.firsts.tobytes(), self.edges.tobytes(),
+                         atom_types.tobytes(), ints.tobytes(),
+                         lengths.tobytes(), text])
+
+    @classmethod
+    def frombytes(cls, data):
+        (magic, little, nodes, edges, atoms, ints, strs,
+         text_size) = ARENA_HEADER.unpack_from(data)
+        if magic != ARENA_MAGIC:
+            raise ValueError('Not a serialized AST')
+        # kinds, values, constants and firsts are 'i', spans 'q'
+        size = (ARENA_HEADER.size + nodes * 24 + edges * 4 + atoms +
+                ints * 8 + strs * 4 + text_size)
+        if size != len(data):
+            raise ValueError('Serialized AST of {} bytes, expected {}'
+                             .format(len(data), size))
+        swap = little != (sys.byteorder == 'little')
+        pos = ARENA_HEADER.size
+
+        def column(typecode, size):
+            nonlocal pos
+            values = array(typecode)
+            end = pos + size * values.itemsize
+            values.frombytes(data[pos:end])
+            if swap:
+                values.byteswap()
+            pos = end
+            return values
+
+        arena = cls()
+        arena.kinds = column('i', nodes)
+        arena.values = column('i', nodes)
+        arena.constants = column('i', nodes)
+        arena.spans = column('q', nodes)
+        arena.firsts = column('i', nodes)
+        arena.edges = column('i', edges)
+        atom_types = column('b', atoms)
+        ints = column('q', ints)
+        lengths = column('i', strs)
+        if (atom_types.count(ATOM_INT) != len(ints) or
+                atom_types.count(ATOM_STR) + atom_types.count(ATOM_BIG_INT)
+                != len(lengths) or sum(lengths) != text_size):
+            raise ValueError('Corrupted serialized AST')
+        ints = iter(ints)
+        lengths = iter(lengths)
+        for atom_type in atom_types:
+            if atom_type == ATOM_INT:
+                atom = next(ints)
+            elif atom_type in (ATOM_STR, ATOM_BIG_INT):
+                end = pos + next(lengths)
+                atom = bytes(data[pos:end]).decode()
+                pos = end
+                if atom_type == ATOM_BIG_INT:
+                    atom = int(atom)
+            else:
+                atom = None
+            arena.atom_ids[atom] = len(arena.atoms)
+            arena.atoms.append(atom)
+        return arena
+
+    def to_tree(self, index=-1):
+        ''' the Node tree of a node (the root by default), rebuilt in one
+        pass over the columns. Shared subtrees stay shared '''
+        nodes = []
+        atoms = self.atoms
+        edges = self.edges
+        ends = self.firsts[1:]
+        ends.append(len(edges))
+        for kind, value, constant, span, first, end in zip(
+                self.kinds, self.values, self.constants, self.spans,
+                self.firsts, ends):
+            if first == end:
+                node = NODE_CLASSES[kind](atoms[value])
+            else:
+                node = NODE_CLASSES[kind](atoms[value], [
+                    nodes[edge] if edge >= 0 else atoms[-1 - edge]
+                    for edge in edges[first:end]])
+            if constant >= 0:
+                node.constant = constant
+            if span >= 0:
+                node.span = span
+            nodes.append(node)
+        return nodes[index]
+
+
+@contextmanager
+def gc_paused():
+    ''' for bulk building long lived objects, which the cyclic garbage
+    collector would otherwise scan over and over '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# returned by an enter_* hook of a Pass: the node is kept as it is and
+# neither its children nor its leave_* hook are walked
+PRUNE = object()
+
+
+class Pass:
+    ''' AST pass walking a tree with an explicit stack (the iterative DFS
+    of r3-calculator/ex2.py) instead of recursing. Subclasses define hooks
+    by node class: enter_<Class>(node) runs before the children of a node
+    are walked and leave_<Class>(node) after them. A class without a hook
+    uses the one of its closest base class (enter_Node for any node), so
+    views and lazy FuncDecs dispatch as the class they stand for.
+
+    A hook returns None to keep the node, or a node to replace it in its
+    parent, whose children tuple is then rebuilt in place; it takes the
+    span of the node it replaces if it has none. A node returned by
+    enter_* is walked instead of the one it replaces (without entering it
+    again). With shared, a node met again (e.g. a hash consed subtree)
+    is not walked twice, the result of its first walk is reused. Arena
+    views can be walked but not rewritten '''
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        # (enter, leave, is a node) by class, filled as classes are met
+        self.hooks = {}
+
+    def hooks_of(self, node_class):
+        enter = leave = None
+        if issubclass(node_class, Node):
+            for base in node_class.__mro__:
+                enter = enter or getattr(self, 'enter_' + base.__name__,
+                                         None)
+                leave = leave or getattr(self, 'leave_' + base.__name__,
+                                         None)
+        hooks = self.hooks[node_class] = (enter, leave,
+                                          issubclass(node_class, Node))
+        return hooks
+
+    def run(self, tree):
+        ''' walks tree, returns its root or the root's replacement. The
+        stack holds nodes to enter and, below their children, a (node,
+        children, leave, original node) entry to finish them; finished
+        nodes wait in results until their parent is finished '''
+        hooks = self.hooks
+        hooks_of = self.hooks_of
+        seen = {} if self.shared else None
+        stack = [tree]
+        pop = stack.pop
+        push = stack.append
+        extend = stack.extend
+        results = []
+        done = results.append
+        with gc_paused():
+            while stack:
+                node = pop()
+                if node.__class__ is tuple:
+                    node, children, leave, original = node
+                    count = len(children)
+                    new_children = tuple(results[-count:])
+                    del results[-count:]
+                    if new_children != children:
+                        node.children = new_children
+                    if leave is not None:
+                        node = replaced(node, leave(node))
+                    if seen is not None:
+                        seen[id(original)] = (original, node)
+                    done(node)
+                    continue
+                enter, leave, is_node = (hooks.get(node.__class__)
+                                         or hooks_of(node.__class__))
+                if not is_node:
+                    # a plain value, e.g. the type of a declaration
+                    done(node)
+                    continue
+                original = node
+                if seen is not None:
+                    walked = seen.get(id(node))
+                    if walked is not None and walked[0] is node:
+                        done(walked[1])
+                        continue
+                if enter is not None:
+                    replacement = enter(node)
+                    if replacement is PRUNE:
+                        done(node)
+                        continue
+                    if replacement is not None:
+                        node = replaced(node, replacement)
+                        leave = (hooks.get(node.__class__)
+                                 or hooks_of(node.__class__))[1]
+                children = node.children
+                if children:
+                    push((node, children, leave, original))
+                    extend(reversed(children))
+                    continue
+                if leave is not None:
+                    node = replaced(node, leave(node))
+                if seen is not None:
+                    seen[id(original)] = (original, node)
+                done(node)
+        return results[0]
+
+
+def replaced(node, replacement):
+    ''' what a Pass hook left of node: node if replacement is None, else
+    replacement, with the span of node if it has none '''
+    if replacement is None:
+        return node
+    if replacement.span is None:
+        replacement.span = node.span
+    return replacement
+
+
+def run_passes(tree, passes):
+    ''' runs each pass on the tree the previous one left '''
+    for ast_pass in passes:
+        tree = ast_pass.run(tree)
+    return tree
+
+
+class ParseCache:
+    ''' parsed programs on disk, so an unchanged source skips the front
+    end. An entry holds the program's names and its AstArena bytes, and is
+    keyed by the sha256 of COMPILER_VERSION, the source and its kind: spans
+    are char offsets in a str source and byte offsets in a bytes one (see
+    open_source), so the two never share an entry. Hits refresh
+    the entry's mtime; once the directory grows over max_size bytes the
+    least recently used entries are removed '''
+
+    suffix = '.ast'
+
+    def __init__(self, directory, max_size=64 << 20):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, src):
+        digest = hashlib.sha256(COMPILER_VERSION.encode())
+        if isinstance(src, str):
+            digest.update(b'str\x00')
+            digest.update(src.encode())
+        else:
+            digest.update(b'bytes\x00')
+            digest.update(src)
+        return os.path.join(self.directory, digest.hexdigest() + self.suffix)
 
-class Tokenizer:
-    def __init__(self, src, pos=0, curr=None):
+    def load(self, src):
+        ''' (tree, names) of a cached source, None on a miss '''
+        path = self.path(src)
+        try:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+            names_size, = CACHE_HEADER.unpack_from(data)
+            end = CACHE_HEADER.size + names_size
+            if end > len(data):
+                raise ValueError('Truncated cache entry')
+            arena = AstArena.frombytes(memoryview(data)[end:])
+            names = NameTable()
+            text = data[CACHE_HEADER.size:end].decode()
+            for name in text.split('\n') if text else []:
+                names.intern(name)
+            with gc_paused():
+                tree = arena.to_tree()
+            os.utime(path)
+        except Exception:
+            # missing, damaged (the columns of a corrupted arena can fail
+            # to_tree in about any way) or just evicted: it is written again
+            return None
+        return tree, names
+
+    def store(self, src, tree, names):
+        arena = AstArena()
+        with gc_paused():
+            arena.add_tree(tree)
+        text = '\n'.join(names.names).encode()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(src)
+        # written aside and renamed, readers never see half an entry
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as fout:
+            fout.write(CACHE_HEADER.pack(len(text)))
+            fout.write(text)
+            fout.write(arena.tobytes())
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+
+class LineIndex:
+    ''' offsets of the line starts of a source, only found when a
+    diagnostic first needs them, so an index can be made up front and
+    shared (e.g. by the parsers of lazy function bodies); lookups are a
+    bisect over them '''
+
+    def __init__(self, src):
         self.src = src
-        self.pos = pos
-        self.curr = curr
-        self.is_comment = False
+        self.starts = None
+
+    def find_starts(self):
+        src = self.src
+        newline = '\n' if isinstance(src, str) else b'\n'
+        starts = array('i', [0])
+        pos = src.find(newline)
+        while pos >= 0:
+            starts.append(pos + 1)
+            pos = src.find(newline, pos + 1)
+        return starts
+
+    def location(self, offset):
+        ''' 1-based (line, column) of a source offset '''
+        if self.starts is None:
+            self.starts = self.find_starts()
+        line = bisect_right(self.starts, offset)
+        return line, offset - self.starts[line - 1] + 1
+
+    def describe(self, offset):
+        return '{}:{}'.format(*self.location(offset))
+
+    def locate(self, node, file_name):
+        ''' file:line:col where a node starts, for diagnostics and profiles,
+        just the file name for a node without a span '''
+        span = span_of(node)
+        if span is None:
+            return file_name
+        return '{}:{}'.format(file_name, self.describe(span[0]))
+
+
+def decode_source(text):
+    ''' text of a bytes source, only tokens and diagnostics are decoded '''
+    return text.decode('utf-8', 'replace')
+
+
+class Trace:
+    ''' buffered sink for tracing events: (phase, rule, token, offset)
+    tuples are kept in memory and only written out by dump() '''
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, phase, rule, token, offset):
+        self.events.append((phase, rule, token, offset))
+
+    def dump(self, fout):
+        fout.writelines('{}\t{}\t{!r}\t{}\n'.format(*event)
+                        for event in self.events)
+
+
+def traced(method, tokens, trace):
+    ''' method reporting each call to trace, along with the current token
+    of tokens '''
+    rule = method.__name__
+
+    def wrapper(*args):
+        trace('parse', rule, tokens.text(), tokens.offset())
+        return method(*args)
+    return wrapper
+
+
+def merge_edits(first, offset, deleted, inserted):
+    ''' the (offset, deleted, inserted) sizes of one edit doing the first
+    one and then replacing the deleted chars at offset by inserted ones '''
+    first_offset, first_deleted, first_inserted = first
+    start = min(first_offset, offset)
+    # end of both edits in the source after the first one, and before it
+    end = max(first_offset + first_inserted, offset + deleted)
+    old_end = end - first_inserted + first_deleted
+    return start, old_end - start, end - start + inserted - deleted
+
+
+class TokenBuffer:
+    ''' token stream stored as a struct of arrays: token i has kind
+    kinds[i], spans src[start(i):end(i)] and has the name id (identifiers)
+    or constant pool index (numbers) values[i], -1 for other tokens.
+
+    After edit() the offsets of the tokens from each of breaks on are
+    stored off by the matching shifts chars, up to the next break, so an
+    edit doesn't have to rewrite the tokens between it and the previous
+    one. start()/end() (or normalize()) give the real offsets '''
+
+    # source chars lexed at a time when re-lexing after an edit
+    relex_window = 256
+    # breaks kept, past them the shortest run of tokens between two is
+    # rewritten to drop its break
+    max_breaks = 256
+
+    def __init__(self, src, names, constants):
+        self.src = src
+        self.names = names
+        self.constants = constants
+        self.kinds = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.values = array('i')
+        self.lines = LineIndex(src)
+        # token indexes where the shift of the stored offsets changes,
+        # ascending, and the shift from each on. The tokens before the
+        # first break, shift_from, hold real offsets
+        self.breaks = []
+        self.shifts = []
+        self.shift_from = sys.maxsize
+        # (offset, deleted, inserted) sizes of the edits since the last one
+        # that lexed, merged into one edit of the source of the tokens
+        self.pending = None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def describe(self, offset):
+        ''' line:col of a source offset, for diagnostics '''
+        return self.lines.describe(offset)
+
+    def start(self, index):
+        if index >= self.shift_from:
+            return self.starts[index] + self.shift_of(index)
+        return self.starts[index]
+
+    def end(self, index):
+        if index >= self.shift_from:
+            return self.ends[index] + self.shift_of(index)
+        return self.ends[index]
+
+    def shift_of(self, index):
+        ''' chars the stored offsets of a token are off by '''
+        if index < self.shift_from:
+            return 0
+        return self.shifts[bisect_right(self.breaks, index) - 1]
+
+    def text(self, index):
+        text = self.src[self.start(index):self.end(index)]
+        return text if isinstance(text, str) else decode_source(text)
+
+    def cursor(self):
+        return TokenCursor(self)
+
+    def normalize(self):
+        ''' applies the pending shifts, starts and ends hold real offsets
+        afterwards '''
+        ends = self.breaks[1:] + [len(self.kinds)]
+        for start, end, shift in zip(self.breaks, ends, self.shifts):
+            self._shift_offsets(start, end, shift)
+        self._set_breaks([], [])
+
+    def edit(self, offset, deleted, inserted, src=None):
+        ''' updates the buffer after replacing the deleted chars at offset
+        by the inserted text. Only the damaged region is lexed again, up to
+        the first token that lines up with an old one (same kind, same
+        shifted start); comments opened or closed by the edit simply keep
+        the re-lexing going until that happens. src is the edited source,
+        if the caller already has it.
+
+        Returns (first, old_end, new_end): old tokens [first, old_end) were
+        replaced by the tokens now at [first, new_end). If the edited
+        source does not lex the error is raised, the buffer takes the new
+        source but keeps its tokens, and the edit is lexed again along
+        with the next one; the indexes returned then are the ones of the
+        tokens before both '''
+        if src is None:
+            src = self.src[:offset] + inserted + self.src[offset + deleted:]
+        inserted = len(inserted)
+        if self.pending is not None:
+            offset, deleted, inserted = merge_edits(self.pending, offset,
+                                                    deleted, inserted)
+        self.src = src
+        self.lines = LineIndex(src)
+        self.pending = (offset, deleted, inserted)
+        delta = inserted - deleted
+        edit_end = offset + inserted
+
+        first = self._first_touching(offset)
+        # right after a token the lexer is never inside a comment
+        restart = self.end(first - 1) if first > 0 else 0
+        tokenizer = Tokenizer(src, restart, self.names, self.constants)
+        tokenizer.window_size = self.relex_window
+
+        kinds, starts, ends, values = (array('i') for _ in range(4))
+        old_end = first
+        size = len(self.kinds)
+        for kind, start, end, value in tokenizer.stream():
+            if start >= edit_end:
+                old_start = start - delta
+                while old_end < size and self.start(old_end) < old_start:
+                    old_end += 1
+                if (old_end < size and self.start(old_end) == old_start and
+                        self.kinds[old_end] == kind):
+                    break
+            kinds.append(kind)
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+        else:
+            old_end = size
+
+        self._splice(first, old_end, kinds, starts, ends, values, delta)
+        self.pending = None
+        return first, old_end, first + len(kinds)
+
+    def _first_touching(self, offset):
+        ''' index of the first token ending at or after offset '''
+        # the run of tokens of one shift holding it: the last one whose
+        # first token ends before offset, or the one after it
+        size = len(self.ends)
+        low = 0
+        shift = 0
+        high = size
+        for brk, brk_shift in zip(self.breaks, self.shifts):
+            if brk >= size or self.ends[brk] + brk_shift >= offset:
+                high = min(brk, size)
+                break
+            low = brk
+            shift = brk_shift
+        return bisect_left(self.ends, offset - shift, low, high)
+
+    def _splice(self, first, old_end, kinds, starts, ends, values, delta):
+        # the new tokens hold real offsets, the ones after them keep their
+        # shifts plus delta: only the breaks change, no token is rewritten
+        size = len(kinds)
+        moved = size - (old_end - first)
+        breaks = []
+        shifts = []
+
+        def add(brk, shift):
+            if breaks and breaks[-1] == brk:
+                # the run of tokens before it is empty
+                breaks.pop()
+                shifts.pop()
+            if shift != (shifts[-1] if shifts else 0):
+                breaks.append(brk)
+                shifts.append(shift)
+
+        low = bisect_left(self.breaks, first)
+        high = bisect_right(self.breaks, old_end)
+        breaks = self.breaks[:low]
+        shifts = self.shifts[:low]
+        add(first, 0)
+        add(first + size, self.shift_of(old_end) + delta)
+        if high < len(self.breaks):
+            add(self.breaks[high] + moved, self.shifts[high] + delta)
+            # the breaks after it still change the shift
+            breaks.extend([brk + moved for brk in self.breaks[high + 1:]])
+            shifts.extend([shift + delta for shift in self.shifts[high + 1:]])
+
+        self.kinds[first:old_end] = kinds
+        self.starts[first:old_end] = starts
+        self.ends[first:old_end] = ends
+        self.values[first:old_end] = values
+        length = len(self.kinds)
+        while breaks and breaks[-1] >= length:
+            breaks.pop()
+            shifts.pop()
+        while len(breaks) > self.max_breaks:
+            self._drop_break(breaks, shifts)
+        self._set_breaks(breaks, shifts)
+
+    def _drop_break(self, breaks, shifts):
+        # the shortest run of tokens takes the shift of the one before it
+        ends = breaks[1:] + [len(self.kinds)]
+        index = min(range(len(breaks)),
+                    key=lambda index: ends[index] - breaks[index])
+        previous = shifts[index - 1] if index else 0
+        self._shift_offsets(breaks[index], ends[index],
+                            shifts[index] - previous)
+        del breaks[index]
+        del shifts[index]
+        if index < len(breaks) and shifts[index] == previous:
+            # the run after it had that shift already
+            del breaks[index]
+            del shifts[index]
+
+    def _set_breaks(self, breaks, shifts):
+        self.breaks = breaks
+        self.shifts = shifts
+        self.shift_from = breaks[0] if breaks else sys.maxsize
+
+    def _shift_offsets(self, start, end, amount):
+        if amount and start < end:
+            add = amount.__add__
+            self.starts[start:end] = array('i', map(add,
+                                                    self.starts[start:end]))
+            self.ends[start:end] = array('i', map(add, self.ends[start:end]))
+
+
+class TokenCursor:
+    ''' walks a TokenBuffer one token at a time, the parser only compares
+    kinds and asks for the values of numbers and identifiers '''
+
+    def __init__(self, buffer, index=-1):
+        self.buffer = buffer
+        self.names = buffer.names
+        self.constants = buffer.constants
+        self.kinds = buffer.kinds
+        self.index = index
+        self.kind = TK_EOF
+
+    @property
+    def lines(self):
+        ''' LineIndex of the buffer's source '''
+        return self.buffer.lines
 
     def get_next(self):
-        if self.pos < len(self.src):
-            self._read()
-            return self.curr
+        self.index += 1
+        if self.index < len(self.kinds):
+            self.kind = self.kinds[self.index]
         else:
-            return None
+            self.index = len(self.kinds)
+            self.kind = TK_EOF
+        return self.kind
+
+    def peek(self, distance=1):
+        index = self.index + distance
+        if index < len(self.kinds):
+            return self.kinds[index]
+        return TK_EOF
+
+    def skip_block(self):
+        ''' moves past the end closing the current function body, see
+        Parser.skip_func_body '''
+        kinds = self.kinds
+        index = self.index
+        blocks = 1
+        depth = 0
+        for index in range(index, len(kinds)):
+            kind = kinds[index]
+            if kind == TK_BEGIN:
+                depth += 1
+            elif kind == TK_END:
+                depth -= 1
+                if depth == 0:
+                    blocks -= 1
+                    if blocks == 0:
+                        break
+            elif kind == TK_FUNCTION and depth == 0:
+                blocks += 1
+        else:
+            index = len(kinds)
+        self.index = index
+        return self.get_next()
+
+    def text(self):
+        if self.kind == TK_EOF:
+            return '<end of file>'
+        return self.buffer.text(self.index)
+
+    def value(self):
+        return self.buffer.values[self.index]
+
+    def offset(self):
+        if self.kind == TK_EOF:
+            return len(self.buffer.src)
+        return self.buffer.start(self.index)
+
+    def end(self):
+        if self.kind == TK_EOF:
+            return len(self.buffer.src)
+        return self.buffer.end(self.index)
+
+    def span(self):
+        ''' packed start and end offsets of the current token '''
+        if self.kind == TK_EOF:
+            end = len(self.buffer.src)
+            return end << SPAN_SHIFT | end
+        buffer = self.buffer
+        index = self.index
+        if index >= buffer.shift_from:
+            shift = buffer.shift_of(index)
+            return ((buffer.starts[index] + shift) << SPAN_SHIFT
+                    | buffer.ends[index] + shift)
+        return buffer.starts[index] << SPAN_SHIFT | buffer.ends[index]
+
+    def previous_end(self):
+        ''' end offset of the token before the current one, the last one
+        of the nodes just parsed '''
+        index = self.index - 1
+        if index < 0:
+            return 0
+        buffer = self.buffer
+        if index >= buffer.shift_from:
+            return buffer.ends[index] + buffer.shift_of(index)
+        return buffer.ends[index]
+
+    def location(self):
+        if self.kind == TK_EOF:
+            return self.buffer.describe(len(self.buffer.src))
+        return self.buffer.describe(self.buffer.start(self.index))
+
+
+class TokenStream:
+    ''' lazy token cursor over Tokenizer.stream(): tokens are lexed a
+    window at a time as the parser pulls them and dropped once consumed,
+    only the current token and the peeked ones are kept '''
+
+    def __init__(self, tokenizer):
+        self.src = tokenizer.src
+        self.names = tokenizer.names
+        self.constants = tokenizer.constants
+        self.tokens = tokenizer.stream()
+        self.lookahead = deque()
+        self.current = None
+        self.previous = None
+        self.kind = TK_EOF
+        self.lines = tokenizer.lines
 
-    def _read(self):
-        self.curr = self._read_any()
+    def get_next(self):
+        self.previous = self.current
+        if self.lookahead:
+            self.current = self.lookahead.popleft()
+        else:
+            self.current = next(self.tokens, None)
+        self.kind = TK_EOF if self.current is None else self.current[0]
+        return self.kind
+
+    def peek(self, distance=1):
+        while len(self.lookahead) < distance:
+            token = next(self.tokens, None)
+            if token is None:
+                return TK_EOF
+            self.lookahead.append(token)
+        return self.lookahead[distance - 1][0]
+
+    def skip_block(self):
+        ''' moves past the end closing the current function body, see
+        Parser.skip_func_body '''
+        blocks = 1
+        depth = 0
+        token = self.current
+        lookahead = self.lookahead
+        tokens = self.tokens
+        while token is not None:
+            kind = token[0]
+            if kind == TK_BEGIN:
+                depth += 1
+            elif kind == TK_END:
+                depth -= 1
+                if depth == 0:
+                    blocks -= 1
+                    if blocks == 0:
+                        break
+            elif kind == TK_FUNCTION and depth == 0:
+                blocks += 1
+            token = lookahead.popleft() if lookahead else next(tokens, None)
+        self.current = token
+        return self.get_next()
+
+    def text(self):
+        if self.current is None:
+            return '<end of file>'
+        kind, start, end, value = self.current
+        text = self.src[start:end]
+        return text if isinstance(text, str) else decode_source(text)
+
+    def value(self):
+        return self.current[3]
+
+    def offset(self):
+        if self.current is None:
+            return len(self.src)
+        return self.current[1]
+
+    def end(self):
+        if self.current is None:
+            return len(self.src)
+        return self.current[2]
+
+    def span(self):
+        ''' packed start and end offsets of the current token '''
+        if self.current is None:
+            return len(self.src) << SPAN_SHIFT | len(self.src)
+        return self.current[1] << SPAN_SHIFT | self.current[2]
+
+    def previous_end(self):
+        ''' end offset of the token before the current one, the last one
+        of the nodes just parsed '''
+        return 0 if self.previous is None else self.previous[2]
+
+    def location(self):
+        if self.current is None:
+            return self.lines.describe(len(self.src))
+        return self.lines.describe(self.current[1])
 
-    def _read_any(self):
-        if self.pos >= len(self.src):
-            return None
-        curr_token = self.src[self.pos]
-        if not self.is_comment:
-            if curr_token in Term.operators:
-                return self._read_term()
-            elif curr_token in Expr.operators or curr_token in COMPARISON:
-                return self._read_operator()
-            elif curr_token in Parent.operators:
-                return self._read_parent()
-            elif curr_token.isdigit():
-                return self._read_int()
-            elif curr_token.isspace():
-                self.pos += 1
-                return self._read_any()
-            elif curr_token == SEMICOLON or curr_token == COMMA:
-                self.pos += 1
-                print('#read_any', curr_token)
-                return RWord(RWORD, curr_token)
-            elif curr_token == OPEN_COMMENT:
-                self.pos += 1
-                self.is_comment = True
-                return self._read_any()
-            elif (curr_token.isalpha() or curr_token == UNDERSCORE or
-                  curr_token in RWord.operators):
-                return self._read_word()
-            else:
-                raise ValueError('Unexpected token at index {id_}: {token}'
-                                 .format(id_=self.pos,
-                                         token=self.src[self.pos]))
-        elif curr_token == CLOSE_COMMENT:
-            self.pos += 1
-            self.is_comment = False
-            return self._read_any()
+
+class Tokenizer:
+    # single precompiled master pattern matching one token, comments are
+    # skipped before matching. Letters, digits and blanks are the ASCII
+    # ones (as in the README grammar), the only ones bytes patterns know
+    master_pattern = re.compile(MASTER_PATTERN, re.VERBOSE | re.ASCII)
+    space_pattern = re.compile(r'\s', re.ASCII)
+
+    # same patterns for bytes sources (e.g. a mmap of the source file),
+    # which are lexed in place through memoryview windows
+    master_pattern_bytes = re.compile(MASTER_PATTERN.encode(), re.VERBOSE)
+    space_pattern_bytes = re.compile(rb'\s')
+
+    # code spans longer than this are lexed a window at a time, so the
+    # temporary lists built for a window stay small
+    window_size = 1 << 20
+
+    def __init__(self, src, pos=0, names=None, constants=None, end=None,
+                 trace=None, diagnostics=None, split=None, lines=None):
+        self.src = src
+        self.pos = pos
+        self.end = len(src) if end is None else end
+        # offset between two tokens a window ends at, e.g. past the end of
+        # a lazy function body: the text after it is only lexed if pulled
+        self.split = split
+        self.is_comment = False
+        self.names = NameTable() if names is None else names
+        self.constants = ConstantPool() if constants is None else constants
+        # optional event sink, gets a ('lex', 'token', text, offset) event
+        # per token
+        self.trace = trace
+        # a list to collect the text that does not lex in and go on without
+        # it, as Parser.recover does for syntax errors. None to raise
+        self.diagnostics = diagnostics
+        # LineIndex of src, to share one with other tokenizers of it
+        self.lines = LineIndex(src) if lines is None else lines
+        self.open_comment = OPEN_COMMENT
+        self.close_comment = CLOSE_COMMENT
+        if not isinstance(src, str):
+            self.master_pattern = self.master_pattern_bytes
+            self.space_pattern = self.space_pattern_bytes
+            self.open_comment = OPEN_COMMENT.encode()
+            self.close_comment = CLOSE_COMMENT.encode()
+
+    def tokenize(self):
+        ''' lexes the whole source (from self.pos on) into a TokenBuffer '''
+        buffer = TokenBuffer(self.src, self.names, self.constants)
+        for window, start in self._source_windows():
+            self._lex_window(buffer, window, start)
+        return buffer
+
+    def stream(self):
+        ''' lazy version of tokenize(), yields (kind, start, end, value)
+        tuples lexing one window at a time '''
+        for window, start in self._source_windows():
+            buffer = TokenBuffer(self.src, self.names, self.constants)
+            self._lex_window(buffer, window, start)
+            yield from zip(buffer.kinds, buffer.starts, buffer.ends,
+                           buffer.values)
+
+    def _source_windows(self):
+        ''' yields (window, start) for the code outside comments. Windows
+        of bytes sources are zero copy memoryview slices, the view is
+        released once done so the caller can close the mmap '''
+        if isinstance(self.src, str):
+            yield from self._slice_windows(self.src)
         else:
-            self.pos += 1
-            return self._read_any()
-
-    def _read_word(self):
-        char = self.src[self.pos]
-        word = ''
-        if char == DOUBLE_DOTS:
-            self.pos += 1
-            word += char + self.src[self.pos]
-            if word.strip() != ASSIGNER:
-                return Word(RWORD, DOUBLE_DOTS)
-            self.pos += 1
-            char = ''
-
-        while char.isalpha() or char == UNDERSCORE:
-            word += char
-            self.pos += 1
-            char = self.src[self.pos]
-        word = word.strip() if word != '' else char
-        print('#read_word', word)
-        return Word(RWORD if word in RWord.operators else VAR, word)
-
-    def _read_parent(self):
-        curr_token = self.src[self.pos]
-        print('#read_parent', curr_token)
-        self.pos += 1
-        if curr_token not in Parent.operators:
-            raise ValueError('Unexpected token at index {id_}: {token}'
-                             .format(id_=self.pos,
-                                     token=self.src[self.pos]))
-        return Parent(curr_token, curr_token)
-
-    def _read_term(self):
-        curr_token = self.src[self.pos]
-        self.pos += 1
-        return Term(curr_token, curr_token)
-
-    def _read_operator(self):
-        current_token = self.src[self.pos]
-        self.pos += 1
-        return Expr(current_token, current_token)
-
-    def _read_int(self):
-        # actually reads an expression with * or / until it "wraps" in a + or -
-        # token
-        if not self.src[self.pos].isdigit():
-            raise ValueError('Unexpected token at index {id_}: {token}'
-                             .format(id_=self.pos,
-                                     token=self.src[self.pos]))
-        val = 0
-        while self.src[self.pos].isdigit():
-            val = val * 10 + int(self.src[self.pos])
-            self.pos += 1
-            if self.pos >= len(self.src):
+            with memoryview(self.src) as view:
+                yield from self._slice_windows(view)
+
+    def _slice_windows(self, src):
+        split = self.split
+        for start, end in self._code_spans():
+            if split is not None and start < split < end:
+                windows = chain(self._windows(start, split),
+                                self._windows(split, end))
+            else:
+                windows = self._windows(start, end)
+            for window_start, window_end in windows:
+                yield src[window_start:window_end], window_start
+
+    def _lex_window(self, buffer, window, start):
+        # split leaves the (blank) gaps between tokens at even indexes and
+        # the tokens at odd ones, so adding up the part lengths gives every
+        # token boundary
+        parts = self.master_pattern.split(window)
+        texts = parts[1::2]
+        if not texts:
+            return
+        bounds = array('i', accumulate(map(len, parts), initial=start))
+        last = 2 * len(texts)
+
+        words = {text: text if isinstance(text, str) else decode_source(text)
+                 for text in dict.fromkeys(texts)}
+        kinds = {text: self._kind_of(word) for text, word in words.items()}
+        starts = bounds[1:last:2]
+        ends = bounds[2:last + 1:2]
+        if None in kinds.values():
+            for index, text in enumerate(texts):
+                if kinds[text] is None:
+                    err = self.error(starts[index], words[text])
+                    if self.diagnostics is None:
+                        raise err
+                    self.diagnostics.append(err)
+            # the tokens that lex are kept
+            valid = [kinds[text] is not None for text in texts]
+            texts = list(compress(texts, valid))
+            starts = array('i', compress(starts, valid))
+            ends = array('i', compress(ends, valid))
+
+        first = len(buffer)
+        intern = self.names.intern
+        add = self.constants.add
+        values = {text: intern(words[text]) if kind == TK_IDENTIFIER else
+                  add(int(text)) if kind == TK_NUM else -1
+                  for text, kind in kinds.items()}
+
+        buffer.kinds.extend(map(kinds.__getitem__, texts))
+        buffer.starts.extend(starts)
+        buffer.ends.extend(ends)
+        buffer.values.extend(map(values.__getitem__, texts))
+        if self.trace is not None:
+            self.trace_tokens(buffer, first)
+
+    def trace_tokens(self, buffer, first):
+        ''' reports the tokens of buffer from index first on to trace '''
+        for index in range(first, len(buffer)):
+            self.trace('lex', 'token', buffer.text(index), buffer.start(index))
+
+    def error(self, offset, word):
+        ''' lexical error for the text word at offset '''
+        if not isinstance(self.src, str):
+            # the whole char, not just its first byte
+            word = decode_source(self.src[offset:offset + 4])[:1]
+        err = ValueError('{}: Unexpected token {}'
+                         .format(self.lines.describe(offset), word))
+        # for Parser.sort_diagnostics
+        err.offset = offset
+        return err
+
+    def _kind_of(self, text):
+        if text in TOKEN_KINDS:
+            return TOKEN_KINDS[text]
+        elif not text.isascii():
+            return None
+        elif text[0].isdigit():
+            return TK_NUM
+        elif text[0].isalpha() or text[0] == UNDERSCORE:
+            return TK_IDENTIFIER
+        return None
+
+    def tokenize_parallel(self, workers=None, chunk_size=4 << 20):
+        ''' same result as tokenize(), with chunks of the source lexed in a
+        process pool. Chunks are cut at blanks, which never split a token,
+        and lexed as if they did not start inside a comment. While stitching
+        the results in order, a chunk that does (a comment crossing the cut)
+        or that failed is lexed again here with the right comment state. The
+        trace gets the tokens of a chunk once it is stitched '''
+        chunks = list(self._windows(self.pos, self.end, chunk_size))
+        buffer = TokenBuffer(self.src, self.names, self.constants)
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(lex_chunk, ((self.src[start:end], start)
+                                           for start, end in chunks))
+            for (start, end), result in zip(chunks, results):
+                if self.is_comment or result is None:
+                    tokenizer = Tokenizer(self.src, start, self.names,
+                                          self.constants, end, self.trace,
+                                          self.diagnostics, lines=self.lines)
+                    tokenizer.is_comment = self.is_comment
+                    for window, window_start in tokenizer._source_windows():
+                        tokenizer._lex_window(buffer, window, window_start)
+                    self.is_comment = tokenizer.is_comment
+                    continue
+
+                (kinds, starts, ends, values, names, constants,
+                 self.is_comment) = result
+                first = len(buffer)
+                # chunk name ids and constant indexes -> ours, -1 stays -1
+                name_ids = [self.names.intern(name) for name in names]
+                constant_ids = [self.constants.add(value)
+                                for value in constants]
+                buffer.kinds.extend(kinds)
+                buffer.starts.extend(starts)
+                buffer.ends.extend(ends)
+                # the chunk's constant indexes follow its name ids (see
+                # lex_chunk), one table remaps both, the lookups run in C
+                table = name_ids + constant_ids + [-1]
+                buffer.values.fromlist(list(map(table.__getitem__, values)))
+                if self.trace is not None:
+                    self.trace_tokens(buffer, first)
+        return buffer
+
+    def _windows(self, start, end, size=None):
+        ''' cuts [start, end) at blanks into spans of about size chars
+        (window_size by default) '''
+        size = self.window_size if size is None else size
+        while end - start > size:
+            blank = self.space_pattern.search(self.src, start + size, end)
+            if blank is None:
                 break
-        return Num(NUM, val)
+            yield start, blank.start()
+            start = blank.start()
+        yield start, end
+
+    def _code_spans(self):
+        ''' yields the (start, end) spans of the source that are not inside
+        a comment, jumping over comment bodies with str.find. Leaves
+        self.is_comment set if the source ends inside a comment '''
+        src = self.src
+        pos = self.pos
+        while pos < self.end:
+            if self.is_comment:
+                pos = src.find(self.close_comment, pos, self.end)
+                if pos < 0:
+                    # unterminated comment, swallows the rest of the source
+                    return
+                pos += 1
+                self.is_comment = False
+            start = src.find(self.open_comment, pos, self.end)
+            if start < 0:
+                yield pos, self.end
+                return
+            yield pos, start
+            pos = start + 1
+            self.is_comment = True
+
+
+def lex_chunk(args):
+    ''' process pool worker for Tokenizer.tokenize_parallel(), lexes one
+    chunk as if it did not start inside a comment. Returns its token
+    columns (offsets already shifted to the whole source, constant
+    indexes after the name ids), its names, constants and whether it ends
+    inside a comment, or None if it could not be lexed '''
+    chunk, offset = args
+    tokenizer = Tokenizer(chunk)
+    try:
+        buffer = tokenizer.tokenize()
+    except ValueError:
+        return None
+    buffer._shift_offsets(0, len(buffer.kinds), offset)
+    # the constant indexes go after the name ids, for the parent to remap
+    # both through one table
+    moves = [0] * len(TOKEN_TEXTS)
+    moves[TK_NUM] = len(buffer.names.names)
+    values = array('i', map(add, buffer.values,
+                            map(moves.__getitem__, buffer.kinds)))
+    return (buffer.kinds, buffer.starts, buffer.ends, values,
+            buffer.names.names, buffer.constants.values,
+            tokenizer.is_comment)
+
+
+def parse_funcs(args):
+    ''' process pool worker for Parser.run_parallel(), parses a batch of
+    function declarations from their token kinds, values (name ids and
+    constant indexes as in the whole program, constants holds the values
+    of the latter) and offsets. spans are the (first, end) token indexes
+    of each one, from its name to the token after it. Returns a FuncDec
+    for each span, None for the ones that did not parse exactly to their
+    end, the caller parses those again to report the error. Also returns
+    the literals of the batch by constant and the nodes holding them, for
+    the caller to share its own (see Parser.share_literals), and if traced
+    the trace events of each span, with no token texts (the batch has no
+    source) '''
+    parser_class, kinds, values, starts, ends, constants, spans, traced = args
+    pool = ConstantPool()
+    pool.values = constants
+    buffer = TokenBuffer('', NameTable(), pool)
+    buffer.kinds = kinds
+    buffer.values = values
+    buffer.starts = starts
+    buffer.ends = ends
+    literals = {}
+    nodes = []
+    events = []
+    with gc_paused():
+        for first, end in spans:
+            trace = Trace() if traced else None
+            parser = parser_class('', TokenCursor(buffer, first - 1), trace)
+            parser.literals = literals
+            events.append(None if trace is None else trace.events)
+            try:
+                node = parser.analyze_single_func_dec()
+            except (ValueError, RecursionError):
+                node = None
+            nodes.append(node if parser.tokens.index == end else None)
+        holders = []
+        stack = [node for node in nodes if node is not None]
+        while stack:
+            node = stack.pop()
+            children = [child for child in node.children
+                        if isinstance(child, Node)]
+            if any(child.__class__ is IntVal for child in children):
+                holders.append(node)
+            stack.extend(children)
+    return nodes, literals, holders, events
 
 
 class Parser:
-    def __init__(self, src):
-        self.tokens = Tokenizer(src)
-        self.value = self.tokens.get_next()
+    def __init__(self, src, tokens=None, trace=None, hash_cons=False,
+                 lazy_functions=False, recover=False):
+        ''' tokens is any token cursor (e.g. TokenBuffer.cursor()), by
+        default the source is lexed lazily through a TokenStream. trace is
+        an optional event sink (e.g. a Trace), the rules are only wrapped
+        to report to it when it is given. hash_cons shares structurally
+        equal pure expressions (see cons). With lazy_functions, function
+        bodies are skipped and only parsed once their FuncDec is used. With
+        recover, syntax errors are collected in diagnostics instead of
+        raised and run() returns what could be parsed (see recover); the
+        ones in lazy function bodies once the bodies are parsed (see
+        parse_lazy_bodies). The default token stream collects the lexical
+        errors in diagnostics too, a given tokens should be made to (see
+        Tokenizer) '''
+        self.diagnostics = [] if recover else None
+        # passed on to the parsers of lazy bodies and parallel batches
+        self.trace = trace
+        if tokens is None:
+            tokens = TokenStream(Tokenizer(src, trace=trace,
+                                           diagnostics=self.diagnostics))
+        self.src = src
+        self.lazy_functions = lazy_functions
+        self.tokens = tokens
+        # the lazy bodies locate their diagnostics with it too
+        self.lines = tokens.lines
+        self.names = tokens.names
+        self.constants = tokens.constants
+        # one shared IntVal per constant pool entry
+        self.literals = {}
+        # canonical pure expression nodes by (class, value, children), None
+        # when hash consing is off
+        self.consed = {} if hash_cons else None
+        self.deduplicated = 0
+        self.error_offset = None
+        # start offset of the last factor parsed
+        self.factor_start = 0
+        if trace is not None:
+            self.trace_rules(trace)
+        self.kind = self.tokens.get_next()
+
+    def trace_rules(self, trace):
+        ''' reports every analyze_* call to trace as a ('parse', rule,
+        token, offset) event, where token is the current token '''
+        for name in dir(self):
+            if name.startswith('analyze_'):
+                setattr(self, name, traced(getattr(self, name), self.tokens,
+                                           trace))
+
+    def cons(self, node):
+        ''' hash consing: the first node seen that is structurally equal to
+        node, if node is a pure expression. Its children are canonical
+        already, so they are compared by identity; a node with an impure
+        child (a read()) is kept as is '''
+        for child in node.children:
+            key = (type(child), child.value, child.children)
+            if self.consed.get(key) is not child:
+                return node
+        key = (type(node), node.value, node.children)
+        canonical = self.consed.get(key)
+        if canonical is None:
+            canonical = self.consed[key] = node
+        else:
+            self.deduplicated += 1
+        return canonical
+
+    def error(self, message):
+        ''' syntax error located at the current token '''
+        return ValueError('{}: {}'.format(self.tokens.location(), message))
+
+    def span(self, start):
+        ''' span from the start offset to the end of the last token read '''
+        return start << SPAN_SHIFT | self.tokens.previous_end()
+
+    def recover(self, err, kinds=SYNC_KINDS):
+        ''' panic mode: records the syntax error err, raised at the current
+        token, and skips to the next token in kinds. Only the first error
+        at a token is kept, the ones cascading from it are dropped. Raises
+        err when the parser is not recovering '''
+        if self.diagnostics is None:
+            raise err
+        offset = self.tokens.offset()
+        if offset != self.error_offset:
+            self.error_offset = offset
+            # for sort_diagnostics
+            err.offset = offset
+            self.diagnostics.append(err)
+        while self.kind not in kinds:
+            self.kind = self.tokens.get_next()
+
+    def recover_begin(self):
+        ''' reports a block not starting with begin. The block is parsed
+        anyway if a begin follows, otherwise it is left empty '''
+        self.recover(self.error('Unexpected token type, expected {}, got {}'
+                                .format(BEGIN, self.tokens.text())))
+        if self.kind == TK_BEGIN:
+            return None
+        if self.kind == TK_END:
+            self.kind = self.tokens.get_next()
+        return Statements(None, [])
 
     def analyze_parent(self):
         node = self.analyze_expr()
-        if self.value.type_ != CLOSE_PARENT:
-            raise ValueError('Unexpected token type, expected ), got {}'
-                             .format(self.value.type_))
+        if self.kind != TK_CLOSE_PARENT:
+            raise self.error('Unexpected token type, expected ), got {}'
+                             .format(self.tokens.text()))
         return node
 
-    def analyze_unary(self, value):
-        return UnOp(value, [self.analyze_factor()])
-
-    def analyze_not(self):
-        print('#analyze_not')
-        return UnOp(NOT, [self.analyze_factor()])
-
     def analyze_factor(self):
-        self.value = self.tokens.get_next()
-        print('#analyze_factor:', self.value.value)
-        if self.value.type_ == OPEN_PARENT:
-            return self.analyze_parent()
-        elif self.value.type_ == MINUS:
-            return self.analyze_unary(MINUS)
-        elif self.value.type_ == PLUS:
-            return self.analyze_unary(PLUS)
-        elif self.value.type_ == NUM:
-            # print('ni hao')
-            return IntVal(self.value.value, [])
-        elif self.value.type_ == VAR:
-            # print('ohai')
-            return Identifier(self.value.value, [])
-        elif self.value.type_ == RWORD and self.value.value == READ:
-            return self.analyze_read()
-        elif self.value.type_ == RWORD and self.value.value == NOT:
-            return self.analyze_not()
+        ''' a factor and the unary operators in front of it, which are
+        collected in a loop instead of recursing once per operator '''
+        unary = []
+        self.kind = self.tokens.get_next()
+        while self.kind in UNARY_KINDS:
+            unary.append((TOKEN_TEXTS[self.kind], self.tokens.offset()))
+            self.kind = self.tokens.get_next()
+
+        if self.kind == TK_IDENTIFIER:
+            span = self.tokens.span()
+            node = Identifier(self.tokens.value(), NO_CHILDREN, span)
+            if self.consed is not None:
+                node = self.cons(node)
+        elif self.kind == TK_NUM:
+            span = self.tokens.span()
+            node = self.analyze_literal(self.tokens.value(), span)
+        elif self.kind == TK_OPEN_PARENT:
+            span = self.tokens.offset() << SPAN_SHIFT
+            node = self.analyze_parent()
+        elif self.kind == TK_READ:
+            node = self.analyze_read()
+            span = node.span
         else:
-            raise ValueError('Unexpected token type, expected factor, got {}'
-                             .format(self.value.type_))
-
-    def analyze_read(self):
-        self.value = self.tokens.get_next()
-        if self.value is not None and self.value.type_ != OPEN_PARENT:
-            raise ValueError('Unexpected token type, expected (, got {}'
-                             .format(self.value.type_))
-
-        self.value = self.tokens.get_next()
-        if self.value is not None and self.value.type_ != CLOSE_PARENT:
-            raise ValueError('Unexpected token type, expected ), got {}'
-                             .format(self.value.type_))
-
-        return ReadOp(RWORD, [])
-
-    def analyze_term(self):
-        print('#analyze_term start:', self.value.value)
-        node = self.analyze_factor()
-        print('#analyze_term', node.value)
-        self.value = self.tokens.get_next()
-        print('#analyze_term value', self.value.value)
-        while self.value is not None and self.value.value in Term.operators:
-            print('#analyze_term -- in loop,', self.value.value)
-            node = BinOp(self.value.value, [node, self.analyze_factor()])
-            self.value = self.tokens.get_next()
-        print('#analyze_term -- exit', self.value.value)
+            raise self.error('Unexpected token type, expected factor, got {}'
+                             .format(self.tokens.text()))
+        if unary:
+            end = self.tokens.end()
+            for value, op_start in reversed(unary):
+                node = UnOp(value, (node,), op_start << SPAN_SHIFT | end)
+                if self.consed is not None:
+                    node = self.cons(node)
+            self.factor_start = unary[0][1]
+        else:
+            self.factor_start = span >> SPAN_SHIFT
         return node
 
-    def analyze_expr(self):
-        print('#analyze_expr', self.value.value)
-        node = self.analyze_simple_expr()
-        while self.value is not None and self.value.type_ in COMPARISON:
-            print('#analyze_expr -- in loop', self.value.value)
-            node = BinOp(self.value.value, [node, self.analyze_simple_expr()])
-        print('#analyze_expr -- exit', self.value.value)
+    def analyze_literal(self, constant, span=None):
+        ''' the shared IntVal of a constant, span is the one of the first
+        occurrence parsed (see span_of) '''
+        node = self.literals.get(constant)
+        if node is None:
+            node = self.literals[constant] = IntVal(self.constants[constant],
+                                                    NO_CHILDREN, constant,
+                                                    span)
+            if self.consed is not None:
+                self.cons(node)
         return node
 
-    def analyze_simple_expr(self):
-        print('#analyze_simple_expr begin:', self.value.value)
-        node = self.analyze_term()
-        print('#analyze_simple_expr node:', node.value)
-        print('#analyze_simple_expr value:', self.value.value)
-        while self.value is not None and self.value.value in Expr.operators:
-            print('#analyze_simple_expr -- in loop::', self.value.value)
-            node = BinOp(self.value.value, [node, self.analyze_term()])
-        print('#analyze_simple_expr -- exit:', self.value.value)
+    def analyze_read(self):
+        start = self.tokens.offset()
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_OPEN_PARENT:
+            raise self.error('Unexpected token type, expected (, got {}'
+                             .format(self.tokens.text()))
+
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_CLOSE_PARENT:
+            raise self.error('Unexpected token type, expected ), got {}'
+                             .format(self.tokens.text()))
+
+        return ReadOp(RWORD, NO_CHILDREN,
+                      start << SPAN_SHIFT | self.tokens.end())
+
+    def analyze_expr(self, min_precedence=1):
+        ''' precedence climbing over BINARY_PRECEDENCE: comparisons, then
+        + - or, then * / and, all left associative. Starts on the token
+        before the expression and stops on the one after it '''
+        node = self.analyze_factor()
+        start = self.factor_start
+        self.kind = self.tokens.get_next()
+        precedence = BINARY_PRECEDENCE[self.kind]
+        while precedence >= min_precedence:
+            value = TOKEN_TEXTS[self.kind]
+            if precedence == MAX_PRECEDENCE:
+                # the right operand is a single factor, no need to recurse
+                right = self.analyze_factor()
+                self.kind = self.tokens.get_next()
+            else:
+                right = self.analyze_expr(precedence + 1)
+            node = BinOp(value, (node, right), self.span(start))
+            if self.consed is not None:
+                node = self.cons(node)
+            precedence = BINARY_PRECEDENCE[self.kind]
         return node
 
     def analyze_print(self):
-        self.value = self.tokens.get_next()
-        print('print = ', self.value.value)
-        if self.value.type_ != OPEN_PARENT:
-            raise ValueError('Unexpected token type, expected (, got {}'
-                             .format(self.value.type_))
+        start = self.tokens.offset()
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_OPEN_PARENT:
+            raise self.error('Unexpected token type, expected (, got {}'
+                             .format(self.tokens.text()))
         node = self.analyze_expr()
-        # self.value = self.tokens.get_next()
-        if self.value.value != CLOSE_PARENT:
-            raise ValueError('Unexpected token type, expected ), got {}'
-                             .format(self.value.value))
-        res = UnOp(PRINT, [node])
-        print('#analyze_print, result::', res)
-        # self.value = self.tokens.get_next()
-        return res
+        if self.kind != TK_CLOSE_PARENT:
+            raise self.error('Unexpected token type, expected ), got {}'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
+        return UnOp(PRINT, (node,), self.span(start))
 
     def analyze_attr(self):
-        var = self.value.value
-        print('var =', var)
-        print('var_type =', self.value.type_)
-        self.value = self.tokens.get_next()
-        print('#analyze_attr', self.value.value)
-        if self.value.value != ASSIGNER:
-            raise ValueError('Unexpected token type, expected \':=\' got "{}"'
-                             .format(self.value.value))
-        return BinOp(ASSIGNER, [Identifier(var, []), self.analyze_expr()])
+        start = self.tokens.offset()
+        var = Identifier(self.tokens.value(), NO_CHILDREN, self.tokens.span())
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_ASSIGNER:
+            raise self.error('Unexpected token type, expected \':=\' got "{}"'
+                             .format(self.tokens.text()))
+        expr_node = self.analyze_expr()
+        return BinOp(ASSIGNER, (var, expr_node), self.span(start))
 
     def analyze_while(self):
-        print('#analyze_while')
-        # self.value = self.tokens.get_next()
-        has_parentesis = self.value.type_ == OPEN_PARENT
+        start = self.tokens.offset()
+        has_parentesis = self.kind == TK_OPEN_PARENT
         expr_node = self.analyze_expr()
-        if has_parentesis and self.value.type_ != CLOSE_PARENT:
-            raise ValueError('Unexpected token type, expected ), got {}'
-                             .format(self.value.value))
-        print('#analyze_while -- read expr, reading do...', self.value.value)
-        # self.value = self.tokens.get_next()
-        if self.value.value != DO:
-            raise ValueError('Unexpected token type, expected "do", got {}'
-                             .format(self.value.value))
-        print('#analyze_while, read do! yay')
-        self.value = self.tokens.get_next()  # for the analyze_stmts bellow
-        return BinOp(WHILE, [expr_node, self.analyze_stmts()])
+        if has_parentesis and self.kind != TK_CLOSE_PARENT:
+            raise self.error('Unexpected token type, expected ), got {}'
+                             .format(self.tokens.text()))
+        if self.kind != TK_DO:
+            raise self.error('Unexpected token type, expected "do", got {}'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()  # for the analyze_stmts bellow
+        body = self.analyze_stmts()
+        return BinOp(WHILE, (expr_node, body), self.span(start))
 
     def analyze_if(self):
-        print('#analyze_if -- begin:', self.value.value)
+        start = self.tokens.offset()
         expr_node = self.analyze_expr()
-        print('#analyze_if -- after expr:', self.value.value)
-        if self.value.value != THEN:
-            raise ValueError('Unexpected token type, expected "then", got {}'
-                             .format(self.value.value))
-        self.value = self.tokens.get_next()
-        print('#analyze_if -- before true branch', self.value.value)
+        if self.kind != TK_THEN:
+            raise self.error('Unexpected token type, expected "then", got {}'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
         true_branch = self.analyze_stmt()
-        print('#analyze_if -- after true branch', self.value.value)
 
-        self.value = self.tokens.get_next()
-        if self.value.value == ELSE:
-            print('#analyze_if -- found else')
-            self.value = self.tokens.get_next()
+        if self.kind == TK_ELSE:
+            self.kind = self.tokens.get_next()
             false_branch = self.analyze_stmt()
         else:
-            print('#analyze_if -- no else')
-            false_branch = NoOp(None, None)
+            false_branch = NoOp(None)
 
-        print('#analyze_if -- EXITING')
-        return TriOp(IF, [expr_node, true_branch, false_branch])
+        return TriOp(IF, (expr_node, true_branch, false_branch),
+                     self.span(start))
 
     def analyze_stmt(self):
         # analyze statement
-        print('stmt =', self.value.value)
-        if self.value.type_ == VAR:
+        if self.kind == TK_IDENTIFIER:
             # atribuicao
             return self.analyze_attr()
-        elif self.value.type_ == RWORD:
-            # reserved word
-            if self.value.value == PRINT:
-                return self.analyze_print()
-            elif self.value.value == BEGIN:
-                return self.analyze_stmts()
-            elif self.value.value == WHILE:
-                return self.analyze_while()
-            elif self.value.value == IF:
-                return self.analyze_if()
-            else:
-                raise ValueError('Unexpected word {}, expected a reserved word'
-                                 .format(self.value.value))
+        elif self.kind == TK_PRINT:
+            return self.analyze_print()
+        elif self.kind == TK_BEGIN:
+            return self.analyze_stmts()
+        elif self.kind == TK_WHILE:
+            return self.analyze_while()
+        elif self.kind == TK_IF:
+            return self.analyze_if()
+        elif self.kind in RESERVED_KINDS:
+            raise self.error('Unexpected word {}, expected a reserved word'
+                             .format(self.tokens.text()))
         else:
-            raise ValueError('Unexpected word {}, expected begin, print or a \
-            variable name'.format(self.value.value))
+            raise self.error('Unexpected word {}, expected begin, print or a \
+            variable name'.format(self.tokens.text()))
 
     def analyze_stmts(self):
         # analyze statements
-        _id = randint(0, 10000)  # for identifing inner stmts (debug)
-        print('#analyze_stmts -- begin #{}'.format(_id))
-        if self.value.value != BEGIN:
-            raise ValueError('Unexpected token type, expected {}, got {}'
-                             .format(BEGIN, self.value.value))
+        start = self.tokens.offset()
+        if self.kind != TK_BEGIN:
+            node = self.recover_begin()
+            if node is not None:
+                return node
 
         nodes = []
-        self.value = self.tokens.get_next()
-        while self.value is not None and self.value.value not in TERMINATORS:
-            print('#analyze_stmts#{}:'.format(_id), self.value.value)
-            nodes.append(self.analyze_stmt())
-            self.value = self.tokens.get_next()
-            print('#analyze_stmts#{} -- next value: {}'
-                  .format(_id, self.value.value))
-            while self.value is not None and self.value.value == SEMICOLON:
+        self.kind = self.tokens.get_next()
+        while self.kind != TK_EOF and self.kind not in TERMINATOR_KINDS:
+            try:
+                nodes.append(self.analyze_stmt())
+            except ValueError as err:
+                # the statement is dropped
+                self.recover(err)
+                if self.kind == TK_FUNCTION:
+                    # most likely a missing end, close the block here
+                    break
+            while self.kind == TK_SEMICOLON:
                 # allows for infinite ; tokens
-                print('#analyze_stmts, got semicolon')
-                self.value = self.tokens.get_next()
+                self.kind = self.tokens.get_next()
 
-        return Statements(None, nodes)
+        if self.kind == TK_END:
+            self.kind = self.tokens.get_next()
+        return Statements(None, nodes, self.span(start))
 
     def analyze_program(self):
-        if self.value.value != PROGRAM:
-            raise ValueError('Unexpected token value {}, expected "program" \
-            keyword'.value.value)
+        if self.kind != TK_PROGRAM:
+            raise self.error('Unexpected token value {}, expected "program" \
+            keyword'.format(self.tokens.text()))
 
         # get program name
-        self.value = self.tokens.get_next()
-        if self.value.type_ == RWORD:
-            raise ValueError('Program name cannot be a reserved word!')
-        elif self.value.type_ != VAR:
-            raise ValueError('Unexpected type {}, expected a variable-like\
-            name'.format(self.value.type_))
-        prog_name = self.value.value
-
-        self.value = self.tokens.get_next()  # should be ;
-        if self.value.value == DOT:
+        self.kind = self.tokens.get_next()
+        if self.kind in RESERVED_KINDS:
+            raise self.error('Program name cannot be a reserved word!')
+        elif self.kind != TK_IDENTIFIER:
+            raise self.error('Unexpected token {}, expected a variable-like\
+            name'.format(self.tokens.text()))
+        prog_name = self.tokens.text()
+
+        self.kind = self.tokens.get_next()  # should be ;
+        if self.kind == TK_DOT:
             return prog_name  # end of the program
-        elif self.value.value != SEMICOLON:
-            raise ValueError('Expected ";", got {}'.format(self.value.value))
+        elif self.kind != TK_SEMICOLON:
+            raise self.error('Expected ";", got {}'.format(self.tokens.text()))
 
         # get next token (standard)
-        self.value = self.tokens.get_next()
+        self.kind = self.tokens.get_next()
         return prog_name
 
     def has_ended(self):
-        return self.value.value == DOT
+        return self.kind == TK_DOT
 
     def analyze_variable_declarations(self):
-        print('#analyze_variable_declarations -- first var name: {}'
-              .format(self.value.value))
         var_names = []
         var_nodes = []
-        while self.value.type_ == VAR:
-            var_names.append(self.value.value)
-            self.value = self.tokens.get_next()
-            if self.value.value == COMMA:
-                print('#analyze_var_dec inside loop, got comma')
-                self.value = self.tokens.get_next()
-            if self.value.value == DOUBLE_DOTS:
+        while self.kind == TK_IDENTIFIER:
+            if not var_names:
+                # every declaration spans its names: type group
+                start = self.tokens.offset()
+            var_names.append(self.tokens.value())
+            self.kind = self.tokens.get_next()
+            if self.kind == TK_COMMA:
+                self.kind = self.tokens.get_next()
+            if self.kind == TK_DOUBLE_DOTS:
                 # get vars type
-                self.value = self.tokens.get_next()
-                var_type = self.value.value
-                if var_type not in Variable.possible_types:
-                    raise ValueError('Unsupported variable type {}'
-                                     .format(self.value.value))
+                self.kind = self.tokens.get_next()
+                if self.kind not in TYPE_KINDS:
+                    # the declaration is dropped, parameters end on a )
+                    self.recover(self.error('Unsupported variable type {}'
+                                            .format(self.tokens.text())),
+                                 SYNC_KINDS | {TK_CLOSE_PARENT})
+                    var_names = []
+                    if self.kind != TK_SEMICOLON:
+                        return var_nodes
+                    self.kind = self.tokens.get_next()
+                    continue
+                var_type = TOKEN_TEXTS[self.kind]
+                span = start << SPAN_SHIFT | self.tokens.end()
                 # add variables to symbol table
                 for var in var_names:
-                    var_nodes.append(BinOp(DOUBLE_DOTS, [var, var_type]))
+                    var_nodes.append(BinOp(DOUBLE_DOTS, (var, var_type),
+                                           span))
                 var_names = []
-                self.value = self.tokens.get_next()
-                if self.value.value != SEMICOLON:
+                self.kind = self.tokens.get_next()
+                if self.kind != TK_SEMICOLON:
                     ''' the last variable does not require a semicolon
                     therefore, if we found smth that is not a semicolon
                     after a var type, it's likely the begining of the
                     next program section '''
                     return var_nodes
-                self.value = self.tokens.get_next()
+                self.kind = self.tokens.get_next()
         return var_nodes
 
     def analyze_single_func_dec(self):
@@ -682,105 +2198,1478 @@ class Parser:
         4) ";"
         5) stmts
         '''
+        start = self.tokens.offset()
+        try:
+            func_name, var_dec, ret_type, span = self.analyze_func_header()
+        except ValueError as err:
+            # the whole function is dropped
+            self.recover(err, HEADER_SYNC_KINDS)
+            if self.kind in (TK_VAR, TK_BEGIN):
+                self.skip_func_body()
+            if self.kind == TK_SEMICOLON:
+                self.kind = self.tokens.get_next()
+            return None
+
+        # 5)
+        header = (VarBlock(None, (BinOp(FUNCTION, (func_name, ret_type),
+                                        span),), span),
+                  VarBlock(None, var_dec, covering(var_dec)))
+        if self.lazy_functions:
+            offset = self.tokens.offset()
+            self.skip_func_body()
+            node = LazyFuncDec(func_name, partial(
+                self.parse_func_body, self.src, self.names, self.constants,
+                self.literals, self.consed, self.diagnostics, self.lines,
+                self.trace, func_name, header, offset, self.tokens.end()),
+                self.span(start))
+        else:
+            block = self.analyze_block(func_name)
+            node = FuncDec(func_name, header + (block,), self.span(start))
+        if self.kind == TK_SEMICOLON:
+            self.kind = self.tokens.get_next()
+        return node
 
+    def analyze_func_header(self):
+        ''' steps 1) to 4) of analyze_single_func_dec, leaves the parser
+        on the start of the body. Returns the name, parameters and type,
+        and the span from the name to the type '''
+        start = self.tokens.offset()
         # 1)
-        if self.value.type_ != VAR:
-            raise ValueError('Function name ({}) is not a variable'
-                             .format(self.value.value))
-        func_name = self.value.value
+        if self.kind != TK_IDENTIFIER:
+            raise self.error('Function name ({}) is not a variable'
+                             .format(self.tokens.text()))
+        func_name = self.tokens.value()
 
         # 2)
-        self.value = self.tokens.get_next()
-        if self.value.value != OPEN_PARENT:
-            raise ValueError('Unexpected token {}, expected "("'
-                             .format(self.value.value))
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_OPEN_PARENT:
+            raise self.error('Unexpected token {}, expected "("'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
         var_dec = self.analyze_variable_declarations()
-        if self.value.value != CLOSE_PARENT:
-            raise ValueError('Unexpected token {}, expected ")"'
-                             .format(self.value.value))
+        if self.kind != TK_CLOSE_PARENT:
+            raise self.error('Unexpected token {}, expected ")"'
+                             .format(self.tokens.text()))
 
         # 3)
-        self.value = self.tokens.get_next()
-        if self.value.value != DOUBLE_DOTS:
-            raise ValueError('Unexpected token {}, expected ":"'
-                             .format(self.value.value))
-        ret_type = self.tokens.get_next()
-        if ret_type not in Variable.possible_types:
-            raise ValueError('Unexpected token {}, expected a variable type'
-                             .format(self.value.value))
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_DOUBLE_DOTS:
+            raise self.error('Unexpected token {}, expected ":"'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
+        if self.kind not in TYPE_KINDS:
+            raise self.error('Unexpected token {}, expected a variable type'
+                             .format(self.tokens.text()))
+        ret_type = TOKEN_TEXTS[self.kind]
+        span = start << SPAN_SHIFT | self.tokens.end()
 
         # 4)
-        self.value = self.tokens.get_next()
-        if self.value.value != SEMICOLON:
-            raise ValueError('Unexpected token {}, expected ";"'
-                             .format(self.value.value))
-
-        # 5)
-        func_body = self.analyze_block(func_name)
-        return FuncDec(func_name, [
-            VarBlock(None, [
-                BinOp(FUNCTION, [func_name, ret_type])
-            ]),
-            VarBlock(None, [var_dec]),
-            func_body
-        ])
+        self.kind = self.tokens.get_next()
+        if self.kind != TK_SEMICOLON:
+            raise self.error('Unexpected token {}, expected ";"'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
+        return func_name, var_dec, ret_type, span
+
+    def skip_func_body(self):
+        ''' jumps over a function body by begin/end balance: its var
+        section, nested functions (each adds one more block to close at
+        nesting 0) and its begin ... end. Stops on the token after it '''
+        self.kind = self.tokens.skip_block()
+
+    @classmethod
+    def parse_func_body(cls, src, names, constants, literals, consed,
+                        diagnostics, lines, trace, func_name, header, offset,
+                        end):
+        ''' FuncDec children of a skipped function body starting at offset,
+        the source is lexed again from there: up to end (that of the token
+        after the body, which the parse reads) first, so a body costs its
+        own size, and on only if the parse goes past it, as recovery can.
+        Takes the state the parser shares instead of the parser, which a
+        LazyFuncDec would keep alive along with its tokens '''
+        parser = cls(src, TokenStream(Tokenizer(src, offset, names,
+                                                constants, trace=trace,
+                                                diagnostics=diagnostics,
+                                                split=end, lines=lines)),
+                     trace, lazy_functions=True)
+        parser.literals = literals
+        parser.consed = consed
+        parser.diagnostics = diagnostics
+        return header + (parser.analyze_block(func_name),)
+
+    def parse_lazy_bodies(self, tree):
+        ''' parses the function bodies of tree still skipped, nested ones
+        included, so their syntax errors are in diagnostics too, which is
+        sorted back in source order. On valid code a body ends where an
+        eager parse ends it, but the begin/end balance that skipped it (see
+        skip_func_body) does not follow recovery: after a syntax error the
+        body and the code after it can be cut elsewhere, and the errors
+        reported from there on differ from the ones of an eager parse '''
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            # reading the children of a LazyFuncDec parses its body
+            stack.extend(child for child in node.children
+                         if isinstance(child, Node))
+        if self.diagnostics:
+            self.sort_diagnostics()
+
+    def sort_diagnostics(self):
+        ''' puts diagnostics in source order, one per offset. Each lazy
+        body has its own parser, which can meet an error the enclosing one
+        did (e.g. at the end of the file, or a lexical error it lexes
+        again). The body's, recorded last, is kept: it is the one an eager
+        parse, going through the body first, would report '''
+        latest = {err.offset: err for err in self.diagnostics}
+        # in place, bodies not parsed yet hold the list
+        self.diagnostics[:] = sorted(latest.values(),
+                                     key=lambda err: err.offset)
 
     def analyze_func_dec(self):
         func_nodes = []
-        if self.value.value != FUNCTION:
+        if self.kind != TK_FUNCTION:
             # no func decs
-            print('#analyze_func_dec -- no function found, returning')
             return func_nodes
-        while self.value.value == FUNCTION:
-            self.value = self.tokens.get_next()
+        while self.kind == TK_FUNCTION:
+            self.kind = self.tokens.get_next()
             node = self.analyze_single_func_dec()
             if node is not None:
                 func_nodes.append(node)
         return func_nodes
 
     def analyze_block(self, program_name):
-        print('#run -- before var_nodes', self.value.value)
-        if self.value.value == VAR:
-            print('#run -- found var k_word, getting next token and calling '
-                  + 'var_dec')
-            self.value = self.tokens.get_next()
+        var_nodes = []
+        if self.kind == TK_VAR:
+            self.kind = self.tokens.get_next()
             var_nodes = self.analyze_variable_declarations()
-        else:
-            print('#run -- did not find var_dec block, skipping to func_dec')
-        self.value = self.tokens.get_next()
         func_nodes = self.analyze_func_dec()
         body_nodes = self.analyze_stmts()
-        return Program(program_name, [
-            VarBlock(None, var_nodes),
-            FuncBlock(None, func_nodes),
+        children = (
+            VarBlock(None, var_nodes, covering(var_nodes)),
+            FuncBlock(None, func_nodes, covering(func_nodes)),
             body_nodes
-        ])
+        )
+        return Program(program_name, children, covering(children))
 
     def run(self):
-        program_name = self.analyze_program()
+        start = self.tokens.offset()
+        try:
+            program_name = self.analyze_program()
+        except ValueError as err:
+            program_name = None
+            self.recover(err, SYNC_KINDS | {TK_VAR})
+            if self.kind == TK_SEMICOLON:
+                self.kind = self.tokens.get_next()
         if self.has_ended():
             # program end
-            return NoOp(None, None)
-        return self.analyze_block(program_name)
+            program = NoOp(None)
+        else:
+            program = self.analyze_block(program_name)
+            # the program spans from its header
+            program.span = self.span(start)
+            if not self.has_ended():
+                self.recover(self.error('Expected ".", got {}'
+                                        .format(self.tokens.text())))
+        if self.diagnostics:
+            # the lexical errors of a window are met before it is parsed
+            self.sort_diagnostics()
+        return program
+
+    def run_parallel(self, workers=None, chunk_size=1 << 17):
+        ''' same result as run(), with the top level function declarations
+        parsed in a process pool. Needs a TokenBuffer cursor; with a token
+        stream, lazy function bodies or hash consing (whose table cannot be
+        shared between processes) this is just run() '''
+        if (not isinstance(self.tokens, TokenCursor) or self.lazy_functions
+                or self.consed is not None):
+            return self.run()
+        analyze_func_dec = self.analyze_func_dec
+        # only the first function section met is the top level one
+        self.analyze_func_dec = partial(self.parse_func_decs_parallel,
+                                        analyze_func_dec, workers,
+                                        chunk_size)
+        try:
+            return self.run()
+        finally:
+            self.analyze_func_dec = analyze_func_dec
+
+    def parse_func_decs_parallel(self, analyze_func_dec, workers,
+                                 chunk_size):
+        ''' analyze_func_dec() for run_parallel(): a begin/end balance scan
+        (as for lazy function bodies) splits the declarations, batches of
+        about chunk_size tokens are parsed by parse_funcs and the FuncDecs
+        are put back in source order. A function that failed is parsed
+        again here, so errors are reported as by run(); if it does not end
+        where the scan said, the rest is parsed here too. The trace gets the
+        events of a batch's functions in their place, as from run() '''
+        self.analyze_func_dec = analyze_func_dec
+        trace = self.trace
+        if trace is not None:
+            # the traced rule this stands in for
+            trace('parse', 'analyze_func_dec', self.tokens.text(),
+                  self.tokens.offset())
+        spans = []
+        while self.kind == TK_FUNCTION:
+            first = self.tokens.index + 1
+            self.tokens.get_next()
+            self.kind = self.tokens.skip_block()
+            if self.kind == TK_SEMICOLON:
+                self.kind = self.tokens.get_next()
+            spans.append((first, self.tokens.index))
+        if not spans:
+            return []
+
+        batches = [[]]
+        batch_first = spans[0][0]
+        for first, end in spans:
+            if first - batch_first >= chunk_size:
+                batches.append([])
+                batch_first = first
+            batches[-1].append((first, end))
+        buffer = self.tokens.buffer
+        buffer.normalize()
+        constants = self.constants.values
+
+        def batch_args(batch):
+            start = batch[0][0]
+            stop = batch[-1][1]
+            # the cursor reads one token past a declaration
+            return (type(self), buffer.kinds[start:stop + 1],
+                    buffer.values[start:stop + 1],
+                    buffer.starts[start:stop + 1],
+                    buffer.ends[start:stop + 1], constants,
+                    [(first - start, end - start) for first, end in batch],
+                    trace is not None)
+
+        func_nodes = []
+        resume = self.tokens.index
+        # the trees are unpickled in a thread of the pool
+        with ProcessPoolExecutor(workers) as pool, gc_paused():
+            for batch, (nodes, literals, holders, events) in zip(
+                    batches, pool.map(parse_funcs, map(batch_args, batches))):
+                self.share_literals(literals, holders)
+                for (first, end), node, func_events in zip(batch, nodes,
+                                                           events):
+                    if node is not None and trace is not None:
+                        # the texts are read from our buffer
+                        for phase, rule, _, offset in func_events:
+                            index = bisect_left(buffer.starts, offset)
+                            trace(phase, rule, buffer.text(index), offset)
+                    if node is None:
+                        self.tokens.index = first - 1
+                        self.kind = self.tokens.get_next()
+                        node = self.analyze_single_func_dec()
+                        if self.tokens.index != end:
+                            # the scan split it wrong, go on from here
+                            if node is not None:
+                                func_nodes.append(node)
+                            return func_nodes + analyze_func_dec()
+                    if node is not None:
+                        func_nodes.append(node)
+        self.tokens.index = resume - 1
+        self.kind = self.tokens.get_next()
+        return func_nodes
+
+    def share_literals(self, literals, holders):
+        ''' makes the trees of a parse_funcs batch use our IntVal of each
+        constant (see analyze_literal) instead of the batch's own ones.
+        holders are the nodes of the batch with IntVal children '''
+        replaced = {}
+        for constant, literal in literals.items():
+            shared = self.literals.setdefault(constant, literal)
+            if shared is not literal:
+                replaced[id(literal)] = shared
+        if not replaced:
+            return
+        for node in holders:
+            node.children = tuple(replaced.get(id(child), child)
+                                  for child in node.children)
+
+
+class StackParser(Parser):
+    ''' parsing mode for deeply nested sources: statements and expressions
+    are parsed walking an explicit stack of open constructs (an iterative
+    DFS, as in r3-calculator/ex2.py) instead of recursing, so the nesting
+    depth is only limited by memory. Builds the same trees as Parser '''
+
+    def analyze_expr(self):
+        ''' operator precedence parsing with an explicit stack: pending
+        operators (and open parenthesis) wait in ops, with the offset of
+        unary ones and (, finished operands in operands and their start
+        offsets in starts. An operator is applied once one with lower
+        precedence (or the end of its parenthesis) follows, unary ones bind
+        tighter than any binary one '''
+        ops = []
+        operands = []
+        starts = []
+        while True:
+            # an operand: unary operators, then a factor or a (
+            self.kind = self.tokens.get_next()
+            while self.kind in UNARY_KINDS:
+                ops.append((UNARY_PRECEDENCE, TOKEN_TEXTS[self.kind],
+                            self.tokens.offset()))
+                self.kind = self.tokens.get_next()
+            if self.kind == TK_OPEN_PARENT:
+                ops.append((0, OPEN_PARENT, self.tokens.offset()))
+                continue
+            starts.append(self.tokens.offset())
+            if self.kind == TK_IDENTIFIER:
+                node = Identifier(self.tokens.value(), NO_CHILDREN,
+                                  self.tokens.span())
+                if self.consed is not None:
+                    node = self.cons(node)
+                operands.append(node)
+            elif self.kind == TK_NUM:
+                operands.append(self.analyze_literal(self.tokens.value(),
+                                                     self.tokens.span()))
+            elif self.kind == TK_READ:
+                operands.append(self.analyze_read())
+            else:
+                raise self.error(
+                    'Unexpected token type, expected factor, got {}'
+                    .format(self.tokens.text()))
+
+            # the operator after it, closing any finished parenthesis
+            while True:
+                self.kind = self.tokens.get_next()
+                precedence = BINARY_PRECEDENCE[self.kind]
+                self.reduce(ops, operands, starts, max(precedence, 1))
+                if precedence:
+                    ops.append((precedence, TOKEN_TEXTS[self.kind], None))
+                    break
+                if not ops:
+                    return operands[0]
+                if self.kind != TK_CLOSE_PARENT:
+                    raise self.error(
+                        'Unexpected token type, expected ), got {}'
+                        .format(self.tokens.text()))
+                # the operand starts on its (
+                starts[-1] = ops.pop()[2]
+
+    def reduce(self, ops, operands, starts, min_precedence):
+        end = self.tokens.previous_end()
+        while ops and ops[-1][0] >= min_precedence:
+            precedence, value, start = ops.pop()
+            if precedence == UNARY_PRECEDENCE:
+                node = UnOp(value, (operands[-1],),
+                            start << SPAN_SHIFT | end)
+                starts[-1] = start
+            else:
+                right = operands.pop()
+                starts.pop()
+                node = BinOp(value, (operands[-1], right),
+                             starts[-1] << SPAN_SHIFT | end)
+            if self.consed is not None:
+                node = self.cons(node)
+            operands[-1] = node
+
+    def analyze_stmts(self):
+        if self.kind != TK_BEGIN:
+            node = self.recover_begin()
+            if node is not None:
+                return node
+        return self.analyze_stmt()
+
+    def analyze_stmt(self):
+        ''' descends into nested statements pushing a frame for each open
+        begin, while or if, then climbs back completing frames with the
+        finished statement until one needs another child statement '''
+        stack = []
+        while True:
+            node = None
+            while node is None:
+                start = self.tokens.offset()
+                try:
+                    if self.kind == TK_BEGIN:
+                        self.kind = self.tokens.get_next()
+                        stack.append((TK_BEGIN, [], start))
+                        node = self.close_block(stack)
+                    elif self.kind == TK_WHILE:
+                        stack.append((TK_WHILE, self.analyze_while_head(),
+                                      start))
+                        if self.kind != TK_BEGIN:
+                            # the body is the block recover_begin makes up,
+                            # as in Parser.analyze_while
+                            node = self.recover_begin()
+                    elif self.kind == TK_IF:
+                        stack.append([TK_IF, self.analyze_if_head(), None,
+                                      start])
+                    else:
+                        node = Parser.analyze_stmt(self)
+                except ValueError as err:
+                    node = self.recover_stmt(err, stack)
+
+            while stack:
+                frame = stack[-1]
+                if frame[0] == TK_BEGIN:
+                    frame[1].append(node)
+                    while self.kind == TK_SEMICOLON:
+                        self.kind = self.tokens.get_next()
+                    node = self.close_block(stack)
+                    if node is None:
+                        break
+                elif frame[0] == TK_WHILE:
+                    stack.pop()
+                    node = BinOp(WHILE, (frame[1], node),
+                                 self.span(frame[2]))
+                elif frame[2] is None and self.kind == TK_ELSE:
+                    # true branch done, parse the else one
+                    frame[2] = node
+                    self.kind = self.tokens.get_next()
+                    break
+                else:
+                    stack.pop()
+                    if frame[2] is None:
+                        branches = (node, NoOp(None))
+                    else:
+                        branches = (frame[2], node)
+                    node = TriOp(IF, (frame[1],) + branches,
+                                 self.span(frame[3]))
+            else:
+                return node
+
+    def recover_stmt(self, err, stack):
+        ''' drops the failed statement, with the while and if frames
+        waiting on it, and goes on with its block as Parser.analyze_stmts
+        does. The block node if that closed it, None otherwise '''
+        self.recover(err)
+        while stack[-1][0] != TK_BEGIN:
+            stack.pop()
+        if self.kind == TK_FUNCTION:
+            frame = stack.pop()
+            return Statements(None, frame[1], self.span(frame[2]))
+        while self.kind == TK_SEMICOLON:
+            self.kind = self.tokens.get_next()
+        return self.close_block(stack)
+
+    def close_block(self, stack):
+        ''' Statements node of the innermost begin frame if its end was
+        reached, None while it has more statements '''
+        if self.kind != TK_EOF and self.kind not in TERMINATOR_KINDS:
+            return None
+        if self.kind == TK_END:
+            self.kind = self.tokens.get_next()
+        frame = stack.pop()
+        return Statements(None, frame[1], self.span(frame[2]))
+
+    def analyze_while_head(self):
+        ''' condition of a while, leaves the parser on the start of its
+        body '''
+        expr_node = self.analyze_expr()
+        if self.kind != TK_DO:
+            raise self.error('Unexpected token type, expected "do", got {}'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
+        return expr_node
+
+    def analyze_if_head(self):
+        ''' condition of an if, leaves the parser on its true branch '''
+        expr_node = self.analyze_expr()
+        if self.kind != TK_THEN:
+            raise self.error('Unexpected token type, expected "then", got {}'
+                             .format(self.tokens.text()))
+        self.kind = self.tokens.get_next()
+        return expr_node
+
+
+# the grammar LL1Parser is generated from, rewritten by hand from the one
+# of README.md, which stays the reference: a grammar change is made in
+# both, and test_calculator checks they have the same rules and keywords.
+# Here progdec is part of programa, read() is a factor, the statements of
+# a block may be followed by any number of ;, and @name marks an action,
+# the LL1Parser.build_name method run once the symbols before it are
+# parsed (see LL1Parser). @start keeps the offset of the token after it,
+# where the node that the next actions build starts
+LL1_EBNF = r'''
+programa = @start, 'program', identificador, @name,
+    (';', bloco, @program | @no_program), '.';
+bloco = @list, ['var', vardec], @var_block, @list, {funcdec, @append},
+    @func_block, comandos, @block;
+vardec = [@start, @list, identificador, @append,
+    {',', identificador, @append}, ':', tipo, @declare, [';', vardec]];
+funcdec = 'function', @start, identificador, '(', @list, vardec, ')', ':',
+    tipo, @func_header, ';', bloco, @func, [';'];
+tipo = ('integer' | 'boolean'), @text;
+comandos = @start, 'begin', @list, {comando, @append, {';'}}, 'end',
+    @statements;
+comando = atribuicao | comandos | print | if | while;
+if = @start, 'if', expressao, 'then', comando, ('else', comando | @no_op),
+    @if;
+while = @start, 'while', expressao, 'do', comandos, @while;
+print = @start, 'print', '(', expressao, ')', @print;
+atribuicao = @start, identificador, @target, ':=', expressao, @assign;
+expressao = expressao_simples,
+    {('<' | '>' | '='), @text, expressao_simples, @binary};
+expressao_simples = termo, {('or' | '+' | '-'), @text, termo, @binary};
+termo = fator, {('*' | '/' | 'and'), @text, fator, @binary};
+fator = @start, ('+' | '-' | 'not'), @text, fator, @unary
+    | @start, numero, @literal | @start, identificador, @identifier
+    | @start, 'read', '(', ')', @read | @start, '(', expressao, ')', @parens;
+'''
+# EBNF names of the terminals the tokenizer reads as a whole
+LL1_TERMINALS = {'identificador': TK_IDENTIFIER, 'numero': TK_NUM}
+LL1_BRACKETS = {'(': ')', '[': ']', '{': '}'}
+
+
+class LL1Grammar:
+    ''' predictive parse table of a grammar in EBNF. Terminals are token
+    kinds, nonterminals are numbered from len(TOKEN_TEXTS) on (the rules
+    in order, then one for each (), [] or {} group) and actions are -1 -
+    their index in actions. table[nonterminal - len(TOKEN_TEXTS)][kind]
+    is the production to expand on a kind, reversed to be pushed on the
+    parse stack, or None for a syntax error.
+
+    A kind in both FIRST and FOLLOW of a nonterminal selects the
+    production it starts, so an else binds to the nearest if; any other
+    conflict raises a ValueError '''
+
+    def __init__(self, ebnf, start):
+        self.names = []
+        self.rules = []
+        self.actions = []
+        self.action_ids = {}
+        rules = []
+        tokens = re.findall(r"'[^']*'|@?\w+|\S", ebnf)
+        while tokens:
+            end = tokens.index(';') if ';' in tokens else len(tokens)
+            if end < 2 or tokens[1] != '=':
+                raise ValueError('Expected "name = ...;", got {}'
+                                 .format(' '.join(tokens[:end + 1])))
+            rules.append(tokens[:end])
+            tokens = tokens[end + 1:]
+        self.nonterminals = {}
+        for rule in rules:
+            self.nonterminals[rule[0]] = self.add_nonterminal(rule[0])
+        for rule in rules:
+            alternatives, pos = self.alternatives(rule, 2, rule[0])
+            if pos != len(rule):
+                raise ValueError('Unexpected {} in {}'.format(rule[pos],
+                                                              rule[0]))
+            self.rules[self.nonterminals[rule[0]] - len(TOKEN_TEXTS)] = (
+                alternatives)
+        self.start = self.nonterminals[start]
+        self.first, self.nullable = self.first_sets()
+        self.follow = self.follow_sets()
+        self.table = self.parse_table()
+
+    def add_nonterminal(self, name, alternatives=None):
+        self.names.append(name)
+        self.rules.append(alternatives)
+        return len(TOKEN_TEXTS) + len(self.rules) - 1
+
+    def alternatives(self, tokens, pos, rule):
+        ''' the alternatives from tokens[pos] up to a closing bracket (or
+        the end), each a tuple of symbols, and the position it stopped on.
+        A group becomes a new nonterminal, unless it is a single sequence
+        between () '''
+        alternatives = [[]]
+        while pos < len(tokens) and tokens[pos] not in (')', ']', '}'):
+            token = tokens[pos]
+            if token == '|':
+                alternatives.append([])
+            elif token in LL1_BRACKETS:
+                inner, pos = self.alternatives(tokens, pos + 1, rule)
+                if pos == len(tokens) or tokens[pos] != LL1_BRACKETS[token]:
+                    raise ValueError('Unclosed {} in {}'.format(token, rule))
+                name = '{}#{}'.format(rule, len(self.rules))
+                if token == '(' and len(inner) == 1:
+                    alternatives[-1].extend(inner[0])
+                elif token == '(':
+                    alternatives[-1].append(self.add_nonterminal(name,
+                                                                 inner))
+                elif token == '[':
+                    alternatives[-1].append(self.add_nonterminal(
+                        name, inner + [()]))
+                else:
+                    symbol = self.add_nonterminal(name)
+                    self.rules[-1] = [alternative + (symbol,)
+                                      for alternative in inner] + [()]
+                    alternatives[-1].append(symbol)
+            elif token != ',':
+                alternatives[-1].append(self.symbol(token, rule))
+            pos += 1
+        return [tuple(alternative) for alternative in alternatives], pos
+
+    def symbol(self, token, rule):
+        if token.startswith("'"):
+            kind = TOKEN_KINDS.get(token[1:-1])
+            if kind is None:
+                raise ValueError('Unknown token {} in {}'.format(token, rule))
+            return kind
+        if token.startswith('@'):
+            action = token[1:]
+            if action not in self.action_ids:
+                self.action_ids[action] = len(self.actions)
+                self.actions.append(action)
+            return -1 - self.action_ids[action]
+        if token in LL1_TERMINALS:
+            return LL1_TERMINALS[token]
+        if token not in self.nonterminals:
+            raise ValueError('Undefined symbol {} in {}'.format(token, rule))
+        return self.nonterminals[token]
+
+    def first_of(self, symbols, first, nullable):
+        ''' FIRST of a sequence of symbols, and whether it can be empty '''
+        kinds = set()
+        for symbol in symbols:
+            if symbol < 0:
+                continue
+            if symbol < len(TOKEN_TEXTS):
+                kinds.add(symbol)
+                return kinds, False
+            kinds |= first[symbol - len(TOKEN_TEXTS)]
+            if not nullable[symbol - len(TOKEN_TEXTS)]:
+                return kinds, False
+        return kinds, True
+
+    def first_sets(self):
+        first = [set() for _ in self.rules]
+        nullable = [False] * len(self.rules)
+        changed = True
+        while changed:
+            changed = False
+            for index, alternatives in enumerate(self.rules):
+                for alternative in alternatives:
+                    kinds, empty = self.first_of(alternative, first, nullable)
+                    if not kinds <= first[index] or empty > nullable[index]:
+                        first[index] |= kinds
+                        nullable[index] |= empty
+                        changed = True
+        return first, nullable
+
+    def follow_sets(self):
+        follow = [set() for _ in self.rules]
+        follow[self.start - len(TOKEN_TEXTS)].add(TK_EOF)
+        changed = True
+        while changed:
+            changed = False
+            for index, alternatives in enumerate(self.rules):
+                for alternative in alternatives:
+                    for pos, symbol in enumerate(alternative):
+                        if symbol < len(TOKEN_TEXTS):
+                            continue
+                        kinds, empty = self.first_of(
+                            alternative[pos + 1:], self.first, self.nullable)
+                        if empty:
+                            kinds |= follow[index]
+                        if not kinds <= follow[symbol - len(TOKEN_TEXTS)]:
+                            follow[symbol - len(TOKEN_TEXTS)] |= kinds
+                            changed = True
+        return follow
+
+    def parse_table(self):
+        table = []
+        for index, alternatives in enumerate(self.rules):
+            row = [None] * len(TOKEN_TEXTS)
+            predicted = set()
+            for alternative in alternatives:
+                kinds, empty = self.first_of(alternative, self.first,
+                                             self.nullable)
+                for kind in kinds:
+                    self.predict(row, index, kind, alternative)
+                predicted |= kinds
+                if empty:
+                    for kind in self.follow[index] - predicted:
+                        self.predict(row, index, kind, alternative)
+            table.append(row)
+        return table
+
+    def predict(self, row, index, kind, alternative):
+        production = alternative[::-1]
+        if row[kind] is not None and row[kind] != production:
+            raise ValueError('Grammar is not LL(1): {} has two productions '
+                             'for {}'.format(self.names[index],
+                                             TOKEN_TEXTS[kind] or kind))
+        row[kind] = production
+
+
+LL1_GRAMMAR = LL1Grammar(LL1_EBNF, 'programa')
+
+
+class LL1Parser(Parser):
+    ''' parser driven by the LL1_GRAMMAR table instead of hand written
+    rules: a loop pops the parse stack, expanding a nonterminal with the
+    production the current token predicts, matching a terminal or running
+    an action. Matched identifiers and numbers push their value on a
+    value stack, which the build_* actions reduce to the same nodes as
+    Parser (hash consing and spans included). Every expression leaves its
+    start offset in starts, the actions building a node pop the ones of
+    its parts. No call recurses, so the nesting depth is only limited by
+    memory. There are no lazy bodies, no error recovery (the first syntax
+    error is raised) and no run_parallel(). A trace gets the expansions of
+    the EBNF rules (groups aside) as its parse events, named after the
+    rules '''
+
+    def __init__(self, src, tokens=None, trace=None, hash_cons=False,
+                 lazy_functions=False, recover=False, grammar=LL1_GRAMMAR):
+        ''' raises ValueError for lazy_functions or recover '''
+        if lazy_functions or recover:
+            raise ValueError('LL1Parser supports neither lazy function '
+                             'bodies nor error recovery')
+        super().__init__(src, tokens, trace, hash_cons)
+        self.grammar = grammar
+
+    def trace_rules(self, trace):
+        ''' the analyze_* rules are not called, run() reports to trace '''
+
+    def run_parallel(self, workers=None, chunk_size=None):
+        ''' raises ValueError: run() does not split the function
+        declarations, the pool would never be used '''
+        raise ValueError('LL1Parser does not parse in parallel')
+
+    def run(self):
+        grammar = self.grammar
+        table = grammar.table
+        actions = [getattr(self, 'build_' + action)
+                   for action in grammar.actions]
+        base = len(TOKEN_TEXTS)
+        get_next = self.tokens.get_next
+        value = self.tokens.value
+        trace = self.trace
+        # the named rules come before the groups
+        rules_end = base + len(grammar.nonterminals) if trace else 0
+        stack = [grammar.start]
+        pop = stack.pop
+        extend = stack.extend
+        values = []
+        push = values.append
+        self.starts = []
+        kind = self.kind
+        matched = None
+        while stack:
+            symbol = pop()
+            if symbol >= base:
+                production = table[symbol - base][kind]
+                if symbol < rules_end:
+                    trace('parse', grammar.names[symbol - base],
+                          self.tokens.text(), self.tokens.offset())
+                if production is None:
+                    self.kind = kind
+                    raise self.expected(
+                        expected for expected, row
+                        in enumerate(table[symbol - base]) if row is not None)
+                extend(production)
+            elif symbol >= 0:
+                if symbol != kind:
+                    self.kind = kind
+                    raise self.expected([symbol])
+                if kind <= TK_IDENTIFIER:
+                    push(value())
+                matched = kind
+                kind = get_next()
+            else:
+                actions[-1 - symbol](values, matched)
+        self.kind = kind
+        return values[0]
+
+    def expected(self, kinds):
+        ''' syntax error at the current token, which is none of kinds '''
+        names = {kind: name for name, kind in LL1_TERMINALS.items()}
+        names[TK_EOF] = 'end of file'
+        return self.error('Unexpected token {}, expected {}'.format(
+            self.tokens.text(),
+            ' or '.join(sorted(names.get(kind) or TOKEN_TEXTS[kind]
+                               for kind in kinds))))
+
+    def build_start(self, values, matched):
+        self.starts.append(self.tokens.offset())
+
+    def build_name(self, values, matched):
+        values[-1] = self.names[values[-1]]
+
+    def build_program(self, values, matched):
+        values[-1].span = self.span(self.starts.pop())
+
+    def build_no_program(self, values, matched):
+        self.starts.pop()
+        values[-1] = NoOp(None)
+
+    def build_list(self, values, matched):
+        values.append([])
+
+    def build_append(self, values, matched):
+        node = values.pop()
+        values[-1].append(node)
+
+    def build_text(self, values, matched):
+        values.append(TOKEN_TEXTS[matched])
+
+    def build_declare(self, values, matched):
+        var_type = values.pop()
+        var_names = values.pop()
+        span = self.span(self.starts.pop())
+        values[-1].extend(BinOp(DOUBLE_DOTS, (var, var_type), span)
+                          for var in var_names)
+
+    def build_var_block(self, values, matched):
+        values[-1] = VarBlock(None, values[-1], covering(values[-1]))
+
+    def build_func_block(self, values, matched):
+        values[-1] = FuncBlock(None, values[-1], covering(values[-1]))
+
+    def build_block(self, values, matched):
+        body_nodes = values.pop()
+        func_block = values.pop()
+        var_block = values.pop()
+        children = (var_block, func_block, body_nodes)
+        values[-1] = Program(values[-1], children, covering(children))
+
+    def build_func_header(self, values, matched):
+        ret_type = values.pop()
+        var_dec = values.pop()
+        func_name = values[-1]
+        span = self.span(self.starts[-1])
+        values.append((VarBlock(None, (BinOp(FUNCTION, (func_name, ret_type),
+                                              span),), span),
+                       VarBlock(None, var_dec, covering(var_dec))))
+        # the name of the function body
+        values.append(func_name)
+
+    def build_func(self, values, matched):
+        block = values.pop()
+        header = values.pop()
+        values[-1] = FuncDec(values[-1], header + (block,),
+                             self.span(self.starts.pop()))
+
+    def build_statements(self, values, matched):
+        values[-1] = Statements(None, values[-1],
+                                self.span(self.starts.pop()))
+
+    def build_no_op(self, values, matched):
+        values.append(NoOp(None))
+
+    def build_if(self, values, matched):
+        false_branch = values.pop()
+        true_branch = values.pop()
+        self.starts.pop()
+        values[-1] = TriOp(IF, (values[-1], true_branch, false_branch),
+                           self.span(self.starts.pop()))
+
+    def build_while(self, values, matched):
+        body = values.pop()
+        self.starts.pop()
+        values[-1] = BinOp(WHILE, (values[-1], body),
+                           self.span(self.starts.pop()))
+
+    def build_print(self, values, matched):
+        self.starts.pop()
+        values[-1] = UnOp(PRINT, (values[-1],), self.span(self.starts.pop()))
+
+    def build_target(self, values, matched):
+        values[-1] = Identifier(values[-1], NO_CHILDREN,
+                                self.span(self.starts[-1]))
+
+    def build_assign(self, values, matched):
+        expr_node = values.pop()
+        self.starts.pop()
+        values[-1] = BinOp(ASSIGNER, (values[-1], expr_node),
+                           self.span(self.starts.pop()))
+
+    def build_binary(self, values, matched):
+        right = values.pop()
+        value = values.pop()
+        self.starts.pop()
+        node = BinOp(value, (values[-1], right), self.span(self.starts[-1]))
+        if self.consed is not None:
+            node = self.cons(node)
+        values[-1] = node
+
+    def build_unary(self, values, matched):
+        self.starts.pop()
+        node = UnOp(values[-2], (values.pop(),), self.span(self.starts[-1]))
+        if self.consed is not None:
+            node = self.cons(node)
+        values[-1] = node
+
+    def build_literal(self, values, matched):
+        values[-1] = self.analyze_literal(values[-1],
+                                          self.span(self.starts[-1]))
+
+    def build_identifier(self, values, matched):
+        node = Identifier(values[-1], NO_CHILDREN, self.span(self.starts[-1]))
+        if self.consed is not None:
+            node = self.cons(node)
+        values[-1] = node
+
+    def build_parens(self, values, matched):
+        # the expression inside keeps its own span, the factor starts on (
+        self.starts.pop()
+
+    def build_read(self, values, matched):
+        values.append(ReadOp(RWORD, NO_CHILDREN,
+                             self.span(self.starts[-1])))
+
+
+class ParseUnit:
+    ''' a statement, begin ... end block or function declaration of a
+    parsed program (or the program itself), the piece IncrementalParser
+    reparses. rule is the Parser method that parses it, length its size
+    in tokens. units are the units nested in it, starts their first
+    tokens relative to this unit's one; as in TokenBuffer, the starts from
+    shift_from on are stored shift tokens off '''
+    __slots__ = ('rule', 'node', 'owner', 'position', 'length', 'units',
+                 'starts', 'shift_from', 'shift')
+
+    def __init__(self, rule):
+        self.rule = rule
+        # node, and where it is in the tree (children[position] of owner)
+        self.node = None
+        self.owner = None
+        self.position = None
+        self.length = 0
+        # only units with nested ones get these
+        self.units = None
+        self.starts = None
+        self.shift_from = 0
+        self.shift = 0
+
+    def add(self, unit, start):
+        if self.units is None:
+            self.units = []
+            self.starts = array('i')
+        self.units.append(unit)
+        self.starts.append(start)
+
+    def start(self, index):
+        if index >= self.shift_from:
+            return self.starts[index] + self.shift
+        return self.starts[index]
+
+    def find(self, offset):
+        ''' index of the last nested unit starting at or before the
+        relative token offset, -1 if there is none '''
+        if self.units is None:
+            return -1
+        index = bisect_right(self.starts, offset, 0, self.shift_from)
+        if index == self.shift_from:
+            index = bisect_right(self.starts, offset - self.shift, index,
+                                 len(self.starts))
+        return index - 1
+
+    def resize(self, index, delta):
+        ''' the nested unit at index grew by delta tokens, the ones after
+        it move '''
+        after = index + 1
+        if self.shift_from < after:
+            self._shift_starts(self.shift_from, after, self.shift)
+        elif self.shift_from > after:
+            self._shift_starts(after, self.shift_from, -self.shift)
+        self.shift_from = after
+        self.shift += delta
+        self.length += delta
+
+    def _shift_starts(self, start, end, amount):
+        if amount and start < end:
+            self.starts[start:end] = array(
+                'i', map(amount.__add__, self.starts[start:end]))
+
+
+class OffsetMap:
+    ''' where the offsets of a source end up after the (offset, deleted,
+    inserted) sizes of edits made in order. The edits are merged into
+    disjoint ranges of the source they replaced: offsets past the end of
+    a range move by its change in size, the ones inside it go to its
+    start. A lookup bisects the ranges, whatever the number of edits '''
+
+    def __init__(self, moves):
+        # (old start, old end, new start, new end) of the ranges, the new
+        # offsets being the ones after the edits merged so far
+        ranges = []
+        for offset, deleted, inserted in moves:
+            ranges = self._merge(ranges, offset, offset + deleted,
+                                 inserted - deleted)
+        self.old_starts = [old_start for old_start, _, _, _ in ranges]
+        self.old_ends = [old_end for _, old_end, _, _ in ranges]
+        self.new_starts = [new_start for _, _, new_start, _ in ranges]
+        self.shifts = [new_end - old_end
+                       for _, old_end, _, new_end in ranges]
+        # ends before it are not moved
+        self.first = self.old_starts[0] if ranges else SPAN_MASK + 1
+
+    @staticmethod
+    def _merge(ranges, start, end, delta):
+        # the chars replaced from start to end in the new offsets join the
+        # ranges they overlap, the ranges after them move by delta
+        low = 0
+        while low < len(ranges) and ranges[low][3] <= start:
+            low += 1
+        shift = ranges[low - 1][3] - ranges[low - 1][1] if low else 0
+        high = low
+        while high < len(ranges) and ranges[high][2] < end:
+            high += 1
+        old_start = start - shift
+        new_start = start
+        old_end = end - shift
+        new_end = end
+        if high > low:
+            if ranges[low][2] <= start:
+                old_start, _, new_start, _ = ranges[low]
+            last = ranges[high - 1]
+            if last[3] >= end:
+                old_end = last[1]
+                new_end = last[3]
+            else:
+                old_end = end - (last[3] - last[1])
+        return (ranges[:low] +
+                [(old_start, old_end, new_start, new_end + delta)] +
+                [(old_start, old_end, new_start + delta, new_end + delta)
+                 for old_start, old_end, new_start, new_end
+                 in ranges[high:]])
+
+    def start(self, offset):
+        ''' where a start offset goes: text inserted at it comes before
+        it '''
+        index = bisect_right(self.old_ends, offset)
+        if index < len(self.old_starts) and self.old_starts[index] < offset:
+            return self.new_starts[index]
+        return offset + self.shifts[index - 1] if index else offset
+
+    def end(self, offset):
+        ''' where an end offset goes: text inserted at it comes after it
+        '''
+        index = bisect_left(self.old_ends, offset)
+        if (index < len(self.old_ends) and self.old_ends[index] == offset
+                and self.old_starts[index] < offset):
+            index += 1
+        if index < len(self.old_starts) and self.old_starts[index] < offset:
+            return self.new_starts[index]
+        return offset + self.shifts[index - 1] if index else offset
+
+    def span(self, span):
+        return (self.start(span >> SPAN_SHIFT) << SPAN_SHIFT |
+                self.end(span & SPAN_MASK))
+
+
+class ShiftSpans(Pass):
+    ''' moves the spans of a tree across the edits moves made since it
+    was parsed, through their OffsetMap. spliced maps the id of a subtree
+    parsed after some of the edits to (subtree, number of those edits):
+    it only takes the later ones, and its ancestors are widened to cover
+    it. The nodes in skipped are left as they are. Subtrees ending before
+    the edits are skipped too, so this walks the nodes after the first
+    edit and the ones enclosing it '''
+
+    def __init__(self, moves, spliced=None, skipped=()):
+        # a node met twice is moved once
+        super().__init__(shared=True)
+        self.moves = moves
+        self.spliced = spliced or {}
+        self.skipped = skipped
+        # maps of the edits after the first ones, by number of first ones
+        self.maps = {}
+        # the maps taken by the nodes being walked, innermost last
+        self.pending = [self.offset_map(0)]
+        # ids of the spliced nodes and the ones widened to cover them
+        self.grown = set()
+
+    def offset_map(self, count):
+        ''' the OffsetMap of the edits after the first count ones '''
+        offsets = self.maps.get(count)
+        if offsets is None:
+            offsets = self.maps[count] = OffsetMap(self.moves[count:])
+        return offsets
+
+    def enter_Node(self, node):
+        if id(node) in self.skipped:
+            return PRUNE
+        offsets = self.pending[-1]
+        spliced = self.spliced.get(id(node))
+        if spliced is not None and spliced[0] is node:
+            offsets = self.offset_map(spliced[1])
+            self.grown.add(id(node))
+        if node.span is not None:
+            if node.span & SPAN_MASK < offsets.first:
+                # and so do the nodes inside it
+                return PRUNE
+            node.span = offsets.span(node.span)
+        self.pending.append(offsets)
+        return None
+
+    def leave_Node(self, node):
+        self.pending.pop()
+        if not self.grown or node.span is None:
+            return None
+        start = node.span >> SPAN_SHIFT
+        end = node.span & SPAN_MASK
+        for child in node.children:
+            if id(child) in self.grown and child.span is not None:
+                self.grown.add(id(node))
+                start = min(start, child.span >> SPAN_SHIFT)
+                end = max(end, child.span & SPAN_MASK)
+        node.span = start << SPAN_SHIFT | end
+        return None
+
+
+# update_spans() walks the nodes after the first edit, each costing
+# about as much as parsing a token, and merges the n logged edits into
+# OffsetMaps, which costs about as much as parsing n ** 3 / SPAN_EDITS_COST
+# tokens. Parsing the whole buffer again is cheaper once the merge costs
+# more than the tokens before the first edit, which the walk skips
+SPAN_EDITS_COST = 30
+
+
+class IncrementalParser(Parser):
+    ''' Parser that keeps the last tree up to date across edits of the
+    source: edit() reparses only the smallest statement, begin ... end
+    block or function declaration that covers the tokens the edit
+    changed, and splices the result into the tree.
+
+    A unit is parsed again by the rule that parsed it, starting on its
+    first token. The result is only kept if that rule stops exactly on
+    the (moved) token after the unit, the tokens around it being the
+    same, the whole program would then parse the same way. Otherwise the
+    enclosing unit is tried, up to the whole program. A node a unit is
+    spliced into holds its children in a list instead of a tuple, which
+    is replaced in place.
+
+    The spans of the nodes kept are not moved by edit(), which would cost
+    a walk of the nodes after the edit: the edits are logged, and
+    update_spans() moves the spans across all of them at once, or parses
+    the buffer again when that costs less '''
+
+    def __init__(self, src, tokens=None, hash_cons=False):
+        ''' tokens must be a TokenBuffer cursor, by default the source is
+        lexed into a new TokenBuffer '''
+        if tokens is None:
+            tokens = Tokenizer(src).tokenize().cursor()
+        super().__init__(src, tokens, hash_cons=hash_cons)
+        self.buffer = tokens.buffer
+        self.root = None
+        self.tree = None
+        # tokens changed since the tree was parsed, when the last edits did
+        # not parse: (first, end, delta) in the indexes of the old tokens
+        self.damage = None
+        # units being parsed, with their absolute first tokens, and the
+        # unit of every node parsed so far
+        self.open_units = []
+        self.unit_of = {}
+        # edits the spans were not moved across yet, and the units and
+        # shared nodes parsed since the first of them, by id: (node,
+        # number of edits before it was parsed)
+        self.moves = []
+        self.spliced = {}
+        self.born = {}
+        # the literal and hash consed nodes this parser makes, only listed
+        # when it reparses a unit
+        self.created = None
+
+    def record(self, analyze):
+        ''' runs the analyze rule, recording the unit it parses as nested
+        in the innermost open one '''
+        unit = ParseUnit(analyze.__name__)
+        first = self.tokens.index
+        self.open_units.append((unit, first))
+        node = analyze(self)
+        self.open_units.pop()
+        parent, parent_first = self.open_units[-1]
+        parent.add(unit, first - parent_first)
+        unit.node = node
+        unit.length = self.tokens.index - first
+        self.unit_of[id(node)] = unit
+        return node
+
+    def analyze_literal(self, constant, span=None):
+        if self.created is None or constant in self.literals:
+            return Parser.analyze_literal(self, constant, span)
+        node = Parser.analyze_literal(self, constant, span)
+        self.created.append(node)
+        return node
+
+    def cons(self, node):
+        size = len(self.consed)
+        canonical = Parser.cons(self, node)
+        if self.created is not None and len(self.consed) > size:
+            self.created.append(canonical)
+        return canonical
+
+    def analyze_stmt(self):
+        if self.kind == TK_BEGIN:
+            # the block is the unit
+            return self.analyze_stmts()
+        return self.record(Parser.analyze_stmt)
+
+    def analyze_stmts(self):
+        return self.record(Parser.analyze_stmts)
+
+    def analyze_single_func_dec(self):
+        return self.record(Parser.analyze_single_func_dec)
+
+    def run(self):
+        root = ParseUnit('run')
+        self.open_units = [(root, 0)]
+        self.tree = root.node = Parser.run(self)
+        root.length = len(self.buffer)
+        self.link_units(self.tree)
+        self.root = root
+        return self.tree
+
+    def run_parallel(self, workers=None, chunk_size=None):
+        ''' units are only recorded in this process, parses as run() '''
+        return self.run()
+
+    def link_units(self, node):
+        ''' sets where every unit parsed below node is in the tree '''
+        unit_of = self.unit_of
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for position, child in enumerate(node.children):
+                if isinstance(child, Node):
+                    unit = unit_of.get(id(child))
+                    if unit is not None:
+                        unit.owner = node
+                        unit.position = position
+                    stack.append(child)
+        self.unit_of = {}
+
+    def edit(self, offset, deleted, inserted):
+        ''' replaces the deleted chars at offset by the inserted text and
+        returns the updated tree. Raises the syntax (or lexical) error if
+        the edited program does not parse; the tree is then left as it was
+        and the tokens changed are reparsed along with the next edit '''
+        if self.root is not None:
+            self.moves.append((offset, deleted, len(inserted)))
+        first, old_end, new_end = self.buffer.edit(offset, deleted,
+                                                   inserted)
+        if self.root is None:
+            return self.reparse_all()
+        delta = new_end - old_end
+        if self.damage is not None:
+            # merge with the tokens the tree is still missing, in the
+            # indexes of the tokens it was parsed from
+            damage_first, damage_end, damage_delta = self.damage
+            first = min(first, damage_first)
+            old_end = max(old_end - damage_delta, damage_end)
+            delta += damage_delta
+        elif first == old_end == new_end:
+            # only blanks or comments changed
+            return self.tree
+        self.damage = (first, old_end, delta)
+
+        # units covering the changed tokens, innermost last, each with its
+        # absolute first token and index in its parent
+        path = []
+        unit = self.root
+        unit_first = 0
+        while True:
+            index = unit.find(first - unit_first)
+            if index < 0:
+                break
+            child_first = unit_first + unit.start(index)
+            child = unit.units[index]
+            if child_first + child.length < old_end:
+                break
+            path.append((unit, index, child_first))
+            unit = child
+            unit_first = child_first
+
+        while path:
+            parent, index, unit_first = path.pop()
+            unit = parent.units[index]
+            try:
+                new_unit = self.reparse(unit, unit_first,
+                                        unit_first + unit.length + delta)
+            except ValueError:
+                if first > unit_first:
+                    # its first token is unchanged, the whole program
+                    # gets to this unit as before and fails the same way
+                    raise
+                new_unit = None
+            if new_unit is not None:
+                break
+        else:
+            return self.reparse_all()
+
+        # splice the new unit in, the ones enclosing it grow by delta
+        owner = unit.owner
+        new_unit.owner = owner
+        new_unit.position = position = unit.position
+        if owner.children.__class__ is not list:
+            # the children of a node edited once are kept in a list from
+            # then on, so splicing into a long block costs the same as
+            # into a short one
+            owner.children = list(owner.children)
+        owner.children[position] = new_unit.node
+        parent.units[index] = new_unit
+        self.spliced[id(new_unit.node)] = (new_unit.node, len(self.moves))
+        parent.resize(index, delta)
+        while path:
+            parent, index, _ = path.pop()
+            parent.resize(index, delta)
+        self.damage = None
+        return self.tree
+
+    def reparse(self, unit, first, end):
+        ''' unit parsed again from the first token, None if its rule does
+        not stop on the end one '''
+        parser = type(self)(self.buffer.src, TokenCursor(self.buffer,
+                                                         first - 1))
+        parser.literals = self.literals
+        parser.consed = self.consed
+        parser.created = []
+        holder = ParseUnit(None)
+        parser.open_units = [(holder, first)]
+        try:
+            node = getattr(parser, unit.rule)()
+        finally:
+            # the spans of the shared nodes parsed are in the edited source
+            for shared in parser.created:
+                self.born[id(shared)] = (shared, len(self.moves))
+        if parser.tokens.index != end or node is None:
+            return None
+        parser.link_units(node)
+        return holder.units[0]
+
+    def reparse_all(self):
+        # the shared nodes are parsed again too, none of the spans of the
+        # new tree is behind an edit
+        self.literals = {}
+        if self.consed is not None:
+            self.consed = {}
+        parser = type(self)(self.buffer.src, self.buffer.cursor())
+        parser.literals = self.literals
+        parser.consed = self.consed
+        self.tree = parser.run()
+        self.root = parser.root
+        self.damage = None
+        self.moves = []
+        self.spliced = {}
+        self.born = {}
+        return self.tree
+
+    def shared_nodes(self):
+        ''' the literal and hash consed nodes, shared by the trees parsed
+        from the buffer '''
+        yield from self.literals.values()
+        if self.consed is not None:
+            yield from self.consed.values()
+
+    def update_spans(self):
+        ''' moves the spans of the tree across the edits made since they
+        were last updated, returns the tree. When that would cost more than
+        a parse (see SPAN_EDITS_COST), the tree is parsed again instead '''
+        if self.damage is None and self.moves:
+            # no offset before the earliest one an edit was made at moved
+            first = min(offset for offset, _, _ in self.moves)
+            skipped = self.buffer._first_touching(first)
+            if len(self.moves) ** 3 > SPAN_EDITS_COST * skipped:
+                return self.reparse_all()
+        if self.moves:
+            # shared nodes are moved once, by the edits after they were
+            # parsed, wherever the tree holds them
+            shared = set()
+            shift = ShiftSpans(self.moves, self.spliced, shared)
+            for node in self.shared_nodes():
+                if id(node) in shared:
+                    # a consed literal
+                    continue
+                born = self.born.get(id(node))
+                count = born[1] if born is not None and born[0] is node else 0
+                if node.span is not None:
+                    node.span = shift.offset_map(count).span(node.span)
+                shared.add(id(node))
+            shift.run(self.tree)
+            self.moves = []
+            self.spliced = {}
+            self.born = {}
+        return self.tree
+
+
+def open_source(fin):
+    ''' maps the source file read only instead of reading it into a str,
+    the tokenizer then works directly on its bytes '''
+    try:
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # empty files cannot be mapped
+        return b''
 
 
 if __name__ == '__main__':
     # for debugging
+    args = sys.argv[1:]
+    use_mmap = MMAP_FLAG in args
+    use_parallel = PARALLEL_FLAG in args
+    use_stack = STACK_FLAG in args
+    use_ll1 = LL1_FLAG in args
+    use_arena = ARENA_FLAG in args
+    hash_cons = HASH_CONS_FLAG in args
+    lazy_functions = LAZY_FLAG in args
+    recover = RECOVER_FLAG in args
+    cache = ParseCache(CACHE_DIR) if CACHE_FLAG in args else None
+    trace = Trace() if TRACE_FLAG in args else None
+    args = [arg for arg in args if arg not in FLAGS]
+    if use_ll1 and (lazy_functions or recover or use_parallel):
+        sys.exit('{} cannot be combined with {}, {} or {}'
+                 .format(LL1_FLAG, LAZY_FLAG, RECOVER_FLAG, PARALLEL_FLAG))
     try:
-        file_name = sys.argv[1]
+        file_name = args[0]
     except IndexError:
         # no arg was passed
         file_name = STD_FILE_NAME
 
     try:
-        with open(file_name, 'r') as fin:
-            src = fin.read()
-            parser = Parser(src)
-            st = SymbolTable()
-            print(src)
-            result = parser.run()
+        with open(file_name, 'rb' if use_mmap else 'r') as fin:
+            src = open_source(fin) if use_mmap else fin.read()
+            if not use_mmap:
+                print(src)
+            cached = None if cache is None else cache.load(src)
+            if cached is not None:
+                result, names = cached
+            else:
+                tokens = None
+                lexical_errors = [] if recover else None
+                if use_parallel:
+                    tokens = Tokenizer(
+                        src, trace=trace, diagnostics=lexical_errors
+                    ).tokenize_parallel().cursor()
+                parser_class = (LL1Parser if use_ll1 else
+                                StackParser if use_stack else Parser)
+                parser = parser_class(
+                    src, tokens, trace, hash_cons, lazy_functions, recover)
+                run = parser.run_parallel if use_parallel else parser.run
+                try:
+                    result = run()
+                finally:
+                    if trace is not None:
+                        # events go to stderr, apart from the program output
+                        trace.dump(sys.stderr)
+                if lazy_functions and recover:
+                    # a body not parsed yet could hold syntax errors
+                    parser.parse_lazy_bodies(result)
+                if lexical_errors:
+                    parser.diagnostics.extend(lexical_errors)
+                    parser.sort_diagnostics()
+                if parser.diagnostics:
+                    # every syntax error found, nothing is run
+                    for err in parser.diagnostics:
+                        print('{}:{}'.format(file_name, err), file=sys.stderr)
+                    sys.exit(1)
+                if hash_cons:
+                    print('[INFO] {} expression nodes shared'
+                          .format(parser.deduplicated), file=sys.stderr)
+                names = parser.names
+                if cache is not None:
+                    cache.store(src, result, names)
+            if use_arena:
+                # keep the tree in arena columns only, run it through views
+                arena = AstArena()
+                arena.add_tree(result)
+                result = arena.view()
+            st = SymbolTable(names)
             print('\n\n================== result ====================\n\n')
-            result.evaluate(st)
+            try:
+                result.evaluate(st)
+            except ValueError as err:
+                if getattr(err, 'node', None) is None:
+                    raise
+                node = err.node
+                if hash_cons and getattr(err, 'statement', None):
+                    # the node may be shared, its span another statement's
+                    node = err.statement
+                print('{}: {}'.format(LineIndex(src).locate(node, file_name),
+                                      err), file=sys.stderr)
+                sys.exit(1)
 
     except IOError as err:
         print(err)
@@ -0,0 +1,776 @@
+''' regression checks for the r8 front end, run with python -m unittest
+(or pytest) from this directory '''
+import gc
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+import weakref
+from unittest import mock
+
+from calculator import (LL1_EBNF, PRUNE, SPAN_SHIFT, TK_EOF, AstArena,
+                        BinOp, FuncDec, Identifier, IncrementalParser,
+                        IntVal, LineIndex, LL1Parser, Node, ParseCache,
+                        Parser, Pass, StackParser, Statements, SymbolTable,
+                        Tokenizer, TokenStream, Trace, TriOp, span_of)
+
+
+def dump(node):
+    ''' node as nested tuples, to compare trees. A lazy FuncDec is
+    compared as the FuncDec it stands for '''
+    if not isinstance(node, Node):
+        return node
+    name = 'FuncDec' if isinstance(node, FuncDec) else type(node).__name__
+    return (name, node.value,
+            tuple(dump(child) for child in node.children))
+
+
+def preorder(tree):
+    ''' the nodes of tree in preorder as (class, value, children count),
+    to compare trees too deep for dump '''
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Node):
+            nodes.append((type(node).__name__, node.value,
+                          len(node.children)))
+            stack.extend(reversed(node.children))
+        else:
+            nodes.append(node)
+    return nodes
+
+
+def spans(node):
+    ''' the spans of node and the nodes under it, but the literals: they
+    are shared, their spans depend on the parse order '''
+    if not isinstance(node, Node):
+        return None
+    return (None if isinstance(node, IntVal) else node.span,
+            [spans(child) for child in node.children])
+
+
+# tokens mutate() inserts, all of them lex
+MUTATION_TOKENS = ['begin', 'end', ';', 'x', ':=', '1', '+', '(', ')', 'if',
+                   'then', 'else', 'while', 'do', 'print', '.', 'function',
+                   'var', ':', 'integer', 'read', 'not', '<']
+
+
+def random_expr(rand, depth=0):
+    choice = rand.randrange(5 if depth < 3 else 2)
+    if choice == 0:
+        return 'x'
+    if choice == 1:
+        return str(rand.randrange(10))
+    if choice == 2:
+        return '({} {} {})'.format(random_expr(rand, depth + 1),
+                                   rand.choice('+-*/<>='),
+                                   random_expr(rand, depth + 1))
+    if choice == 3:
+        return '{} {} {}'.format(random_expr(rand, depth + 1),
+                                 rand.choice(['+', '*', 'and', 'or', '<']),
+                                 random_expr(rand, depth + 1))
+    return 'not ' + random_expr(rand, depth + 1)
+
+
+def random_stmt(rand, depth):
+    choice = rand.randrange(6 if depth < 4 else 2)
+    if choice == 0:
+        return 'x := ' + random_expr(rand)
+    if choice == 1:
+        return 'print({})'.format(random_expr(rand))
+    if choice == 2:
+        return random_block(rand, depth + 1)
+    if choice == 3:
+        return 'while {} do {}'.format(random_expr(rand),
+                                       random_block(rand, depth + 1))
+    if choice == 4:
+        stmt = 'if {} then {}'.format(random_expr(rand),
+                                      random_stmt(rand, depth + 1))
+        if rand.random() < 0.5:
+            stmt += ' else ' + random_stmt(rand, depth + 1)
+        return stmt
+    return 'y := read()'
+
+
+def random_block(rand, depth=0):
+    return 'begin {} end'.format('; '.join(
+        random_stmt(rand, depth) for _ in range(rand.randrange(1, 4))))
+
+
+def random_program(rand):
+    funcs = ''.join('function {}(n: integer): integer; var y: integer {}; '
+                    .format(name, random_block(rand, 1))
+                    for name in ['fa', 'fb'][:rand.randrange(3)])
+    return 'program p; var x, y: integer; b: boolean {} {}.'.format(
+        funcs, random_block(rand))
+
+
+def mutate(rand, src):
+    ''' src with a token or two deleted, inserted or replaced '''
+    words = src.replace('(', ' ( ').replace(')', ' ) ').replace(
+        ';', ' ; ').split()
+    for _ in range(rand.randrange(1, 3)):
+        i = rand.randrange(len(words))
+        change = rand.randrange(3)
+        if change == 0:
+            del words[i]
+        elif change == 1:
+            words.insert(i, rand.choice(MUTATION_TOKENS))
+        else:
+            words[i] = rand.choice(MUTATION_TOKENS)
+    return ' '.join(words)
+
+
+def outcome(parser_class, src, **options):
+    ''' tree and diagnostics of a parse, or the syntax error raised '''
+    try:
+        parser = parser_class(src, **options)
+        tree = parser.run()
+    except ValueError as err:
+        return str(err)
+    return dump(tree), [str(err) for err in parser.diagnostics or []]
+
+
+def ebnf_terminals(ebnf):
+    ''' the quoted terminals of each rule of an EBNF grammar '''
+    tokens = re.findall(r"'[^']*'|@?\w+|\S", ebnf)
+    rules = {}
+    while tokens:
+        end = tokens.index(';')
+        rules[tokens[0]] = {token for token in tokens[2:end]
+                            if token.startswith("'")}
+        tokens = tokens[end + 1:]
+    return rules
+
+
+def token_list(buffer):
+    return [(buffer.kinds[i], buffer.start(i), buffer.end(i),
+             buffer.values[i]) for i in range(len(buffer))]
+
+
+class LazyFunctionsTest(unittest.TestCase):
+
+    src = ('program p; var x: integer function f(n: integer): integer; '
+           'begin f := n + 1 end; begin x := 1; print(x) end.')
+
+    def test_lazy_bodies_do_not_keep_the_parser(self):
+        parser = Parser(self.src, lazy_functions=True)
+        tree = parser.run()
+        parser_ref = weakref.ref(parser)
+        del parser
+        gc.collect()
+        self.assertIsNone(parser_ref())
+        self.assertEqual(dump(tree), dump(Parser(self.src).run()))
+
+    def test_recover_reports_errors_in_bodies(self):
+        src = ('program p; var x: integer function f(n: integer): integer; '
+               'begin f := n + ; end; begin x := 1 +; print(x) end.')
+        parser = Parser(src, lazy_functions=True, recover=True)
+        parser.parse_lazy_bodies(parser.run())
+        eager = Parser(src, recover=True)
+        eager.run()
+        self.assertEqual([str(err) for err in parser.diagnostics],
+                         [str(err) for err in eager.diagnostics])
+        self.assertEqual(len(parser.diagnostics), 2)
+
+    def test_error_met_by_a_body_and_its_program_is_reported_once(self):
+        # both parsers reach the end of the file in an error
+        src = ('program p; var x: integer function f(n: integer): '
+               'integer; begin f := n +')
+        parser = Parser(src, lazy_functions=True, recover=True)
+        parser.parse_lazy_bodies(parser.run())
+        eager = Parser(src, recover=True)
+        eager.run()
+        self.assertEqual([str(err) for err in parser.diagnostics],
+                         [str(err) for err in eager.diagnostics])
+
+    def test_forcing_bodies_lexes_each_once(self):
+        funcs = ''.join('function f{}(n: integer): integer; begin x := n; '
+                        'if x > 2 then print(x) end; '.format('z' * i)
+                        for i in range(1, 200))
+        src = 'program p; var x: integer {} begin x := 1 end.'.format(funcs)
+        parser = Parser(src, lazy_functions=True)
+        tree = parser.run()
+        lexed = []
+        lex_window = Tokenizer._lex_window
+
+        def counted(tokenizer, buffer, window, start):
+            lexed.append(len(window))
+            return lex_window(tokenizer, buffer, window, start)
+
+        with mock.patch.object(Tokenizer, '_lex_window', counted):
+            parser.parse_lazy_bodies(tree)
+        # each body and the ; after it, not the rest of the file
+        self.assertLess(sum(lexed), len(src))
+        self.assertEqual(dump(tree), dump(Parser(src).run()))
+
+    def test_bodies_share_the_line_index(self):
+        funcs = ''.join('function f{}(n: integer): integer;\nbegin '
+                        'f := n +\nend;\n'.format('z' * i)
+                        for i in range(1, 50))
+        src = 'program p; var x: integer\n{}begin x := 1 end.'.format(funcs)
+        parser = Parser(src, lazy_functions=True, recover=True)
+        with mock.patch.object(LineIndex, 'find_starts',
+                               autospec=True,
+                               side_effect=LineIndex.find_starts) as found:
+            parser.parse_lazy_bodies(parser.run())
+        self.assertEqual(len(parser.diagnostics), 49)
+        self.assertEqual(found.call_count, 1)
+
+    def test_bodies_report_to_the_trace(self):
+        trace = Trace()
+        parser = Parser(self.src, trace=trace, lazy_functions=True)
+        parser.parse_lazy_bodies(parser.run())
+        eager = Trace()
+        Parser(self.src, trace=eager).run()
+        # a body's rules are reported once it is parsed, after the rest
+        self.assertEqual(sorted(e for e in trace.events if e[0] == 'parse'),
+                         sorted(e for e in eager.events if e[0] == 'parse'))
+        self.assertIn(('parse', 'analyze_stmt', 'f', self.src.index('f :=')),
+                      trace.events)
+
+    def test_spans_of_unshared_nodes_match_parser(self):
+        tree = Parser(self.src, lazy_functions=True).run()
+        self.assertEqual(spans(tree), spans(Parser(self.src).run()))
+
+
+class LL1ParserTest(unittest.TestCase):
+
+    src = 'program p; var x: integer begin x := 1; print(x) end.'
+
+    def test_unsupported_options_raise(self):
+        for options in ({'lazy_functions': True}, {'recover': True}):
+            with self.assertRaises(ValueError):
+                LL1Parser(self.src, **options)
+        tokens = Tokenizer(self.src).tokenize().cursor()
+        with self.assertRaises(ValueError):
+            LL1Parser(self.src, tokens).run_parallel()
+
+    def test_grammar_follows_the_readme(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'README.md')
+        with open(path) as fin:
+            readme = fin.read()
+        readme = ebnf_terminals(
+            readme.split('## EBNF')[1].split('```')[1])
+        # the tokenizer reads these
+        for rule in ('identificador', 'numero', 'letra', 'digito'):
+            del readme[rule]
+        # LL1_EBNF inlines these
+        readme['programa'] |= readme.pop('progdec')
+        readme['fator'] |= readme.pop('read')
+        self.assertEqual(ebnf_terminals(LL1_EBNF), readme)
+
+    def test_trace_reports_the_rules(self):
+        events = []
+        LL1Parser(self.src, trace=lambda *event: events.append(event)).run()
+        rules = [event[1] for event in events if event[0] == 'parse']
+        self.assertEqual(rules[:5], ['programa', 'bloco', 'vardec', 'tipo',
+                                     'comandos'])
+        self.assertIn(('parse', 'print', 'print',
+                       self.src.index('print')), events)
+
+    def test_same_tree_as_parser(self):
+        self.assertEqual(dump(LL1Parser(self.src).run()),
+                         dump(Parser(self.src).run()))
+
+
+class RecoverTest(unittest.TestCase):
+
+    src = ('program p;\nvar x: integer\nbegin x := 1 +;\n'
+           '  x := 2 ! 3;\n  print(x) end.')
+
+    def test_lexical_errors_are_diagnostics(self):
+        for src in (self.src, self.src.encode()):
+            parser = Parser(src, recover=True)
+            parser.run()
+            messages = [str(err) for err in parser.diagnostics]
+            self.assertEqual(messages[:2], [
+                '3:15: Unexpected token type, expected factor, got ;',
+                '4:10: Unexpected token !'])
+        with self.assertRaises(ValueError):
+            Parser(self.src).run()
+
+    def test_lexical_errors_of_a_parallel_lex(self):
+        errors = []
+        tokens = Tokenizer(self.src, diagnostics=errors).tokenize_parallel(
+            1).cursor()
+        self.assertEqual([str(err) for err in errors],
+                         ['4:10: Unexpected token !'])
+        parser = Parser(self.src, tokens, recover=True)
+        tree = parser.run()
+        self.assertEqual(dump(tree), dump(Parser(self.src,
+                                                 recover=True).run()))
+
+
+class StackParserTest(unittest.TestCase):
+
+    def test_while_body_that_is_not_a_block(self):
+        # the stray end is the while body, as for Parser
+        src = ('program p; var x: integer begin if x then while x do end; '
+               'x := 1 +; print(x) end.')
+        parser = StackParser(src, recover=True)
+        tree = parser.run()
+        self.assertEqual(len(parser.diagnostics), 2)
+        self.assertEqual(outcome(StackParser, src, recover=True),
+                         outcome(Parser, src, recover=True))
+        self.assertEqual(len(tree.children[2].children), 2)
+
+    def test_same_diagnostics_as_parser(self):
+        rand = random.Random(20)
+        for _ in range(300):
+            src = mutate(rand, random_program(rand))
+            for recover in (False, True):
+                self.assertEqual(
+                    outcome(StackParser, src, recover=recover),
+                    outcome(Parser, src, recover=recover), src)
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+
+    def test_same_trees_and_spans(self):
+        rand = random.Random(13)
+        for _ in range(200):
+            src = random_program(rand)
+            tree = Parser(src).run()
+            for parser_class in (StackParser, LL1Parser):
+                other = parser_class(src).run()
+                self.assertEqual(dump(other), dump(tree), src)
+                self.assertEqual(spans(other), spans(tree), src)
+
+    def test_ll1_accepts_no_more_than_parser(self):
+        # Parser lets a missing end or ; go, LL1Parser follows the grammar
+        rand = random.Random(23)
+        for _ in range(300):
+            src = mutate(rand, random_program(rand))
+            result = outcome(LL1Parser, src)
+            if isinstance(result, tuple):
+                self.assertEqual(result, outcome(Parser, src), src)
+
+    def test_deep_nesting(self):
+        depth = 5000
+        src = 'program p; var x: integer begin {}x := {}1{}{} end.'.format(
+            'begin ' * depth, '(' * depth, ')' * depth, ' end' * depth)
+        # more levels than Parser can recurse through, whatever the limit
+        limit = sys.getrecursionlimit()
+        self.addCleanup(sys.setrecursionlimit, limit)
+        sys.setrecursionlimit(1000)
+        with self.assertRaises(RecursionError):
+            Parser(src).run()
+        tree = StackParser(src).run()
+        self.assertEqual(preorder(LL1Parser(src).run()), preorder(tree))
+
+
+class HashConsTest(unittest.TestCase):
+
+    def test_shared_expressions_are_counted(self):
+        src = ('program p; var x, y: integer begin x := (1 + y) * (1 + y); '
+               'y := read() + read(); print(1 + y) end.')
+        parser = Parser(src, hash_cons=True)
+        tree = parser.run()
+        # the second and third y and 1 + y, not the reads
+        self.assertEqual(parser.deduplicated, 4)
+        product = tree.children[2].children[0].children[1]
+        self.assertIs(product.children[0], product.children[1])
+        reads = tree.children[2].children[1].children[1]
+        self.assertIsNot(reads.children[0], reads.children[1])
+        self.assertEqual(dump(tree), dump(Parser(src).run()))
+
+
+class PassTest(unittest.TestCase):
+
+    src = ('program p; var x, y: integer begin x := (1 + y) * (1 + y); '
+           'if x > 1 then print(y + 1) end.')
+
+    def test_replacements_and_prune(self):
+        class Rewrite(Pass):
+            def __init__(self):
+                super().__init__()
+                self.entered = []
+
+            def enter_Node(self, node):
+                self.entered.append(type(node).__name__)
+
+            def enter_TriOp(self, node):
+                return PRUNE
+
+            def leave_Identifier(self, node):
+                return Identifier(node.value + 100)
+
+        parser = Parser(self.src)
+        tree = parser.run()
+        x = parser.names.intern('x')
+        span = span_of(tree.children[2].children[0].children[0])
+        rewrite = Rewrite()
+        self.assertIs(rewrite.run(tree), tree)
+        assign, if_ = tree.children[2].children
+        self.assertEqual(assign.children[0].value, x + 100)
+        # the replacement takes the span of the node it replaces
+        self.assertEqual(span_of(assign.children[0]), span)
+        # the if and the nodes under it are not walked
+        self.assertEqual(rewrite.entered.count('Identifier'), 3)
+        self.assertNotIn('TriOp', rewrite.entered)
+        self.assertEqual(if_.children[0].children[0].value, x)
+
+    def test_shared_nodes_are_walked_once(self):
+        class Count(Pass):
+            def __init__(self, shared):
+                super().__init__(shared)
+                self.count = 0
+
+            def leave_BinOp(self, node):
+                self.count += 1
+
+        tree = Parser(self.src, hash_cons=True).run()
+        counts = []
+        for shared in (False, True):
+            count = Count(shared)
+            count.run(tree)
+            counts.append(count.count)
+        # the two declarations, := * 1+y 1+y > y+1, the second 1 + y is
+        # shared
+        self.assertEqual(counts, [8, 7])
+
+    def test_deep_trees(self):
+        depth = 5000
+        src = 'program p; var x: integer begin x := {}1{} end.'.format(
+            '(x + ' * depth, ')' * depth)
+        tree = StackParser(src).run()
+
+        class Count(Pass):
+            count = 0
+
+            def leave_BinOp(self, node):
+                self.count += 1
+
+        count = Count()
+        count.run(tree)
+        # the declaration, := and the +
+        self.assertEqual(count.count, depth + 2)
+
+
+class TokenStreamTest(unittest.TestCase):
+
+    src = ('program p; var x: integer function f(n: integer): integer; '
+           'begin f := n end; begin x := f(1) end.')
+
+    def test_same_tokens_as_a_buffer(self):
+        buffer = Tokenizer(self.src).tokenize()
+        tokenizer = Tokenizer(self.src)
+        # windows of a few tokens, lexed as the stream is pulled
+        tokenizer.window_size = 8
+        stream = TokenStream(tokenizer)
+        tokens = []
+        while stream.get_next() != TK_EOF:
+            tokens.append(stream.current)
+        self.assertEqual(tokens, token_list(buffer))
+
+    def test_peek_and_skip_block(self):
+        stream = TokenStream(Tokenizer(self.src))
+        cursor = Tokenizer(self.src).tokenize().cursor()
+        for tokens in (stream, cursor):
+            tokens.get_next()
+            ahead = tokens.peek(2)
+            tokens.get_next()
+            self.assertEqual(tokens.peek(1), ahead)
+            while tokens.text() != 'begin':
+                tokens.get_next()
+            # past the end of f's body, on its ;
+            tokens.skip_block()
+            self.assertEqual(tokens.text(), ';')
+            self.assertEqual(tokens.offset(), self.src.index('; begin x'))
+
+
+class ParallelParseTest(unittest.TestCase):
+
+    def test_literals_are_shared(self):
+        funcs = ''.join('function f{0}(n: integer): integer; '
+                        'begin f{0} := n + 1 end; '.format('abc'[i])
+                        for i in range(3))
+        src = 'program p; var x: integer {} begin x := 1 end.'.format(funcs)
+        parser = Parser(src, Tokenizer(src).tokenize().cursor())
+        tree = parser.run_parallel(2, chunk_size=1)
+        stack = [tree]
+        literals = []
+        while stack:
+            node = stack.pop()
+            if isinstance(node, IntVal):
+                literals.append(node)
+            elif isinstance(node, Node):
+                stack.extend(node.children)
+        self.assertEqual(len(literals), 4)
+        for literal in literals:
+            self.assertIs(literal, parser.literals[literal.constant])
+        self.assertEqual(spans(tree), spans(Parser(src).run()))
+
+    def test_trace_matches_run(self):
+        funcs = ''.join('function f{0}(n: integer): integer; '
+                        'begin f{0} := n * {1} end; '.format('abc'[i], i)
+                        for i in range(3))
+        src = 'program p; var x: integer {} begin x := 1 end.'.format(funcs)
+        trace = Trace()
+        tokens = Tokenizer(src, trace=trace).tokenize_parallel(
+            2, chunk_size=40).cursor()
+        Parser(src, tokens, trace).run_parallel(2, chunk_size=1)
+        sequential = Trace()
+        Parser(src, trace=sequential).run()
+        self.assertEqual(trace.events, sequential.events)
+
+
+class EvaluateTest(unittest.TestCase):
+
+    src = ('program p; var x: integer '
+           'function f(n: integer): integer; begin f := y + 1 end; '
+           'begin x := 1; print(y + 1) end.')
+
+    def error(self, hash_cons):
+        parser = Parser(self.src, hash_cons=hash_cons)
+        tree = parser.run()
+        with self.assertRaises(ValueError) as caught:
+            tree.evaluate(SymbolTable(parser.names))
+        return caught.exception
+
+    def test_error_locates_the_failing_occurrence(self):
+        print_start = self.src.index('print')
+        err = self.error(False)
+        self.assertEqual(span_of(err.node)[0], print_start + 6)
+        self.assertEqual(span_of(err.statement)[0], print_start)
+        # the shared y is the one of the function, the statement is not
+        err = self.error(True)
+        self.assertEqual(span_of(err.statement)[0], print_start)
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def test_bytes_and_str_sources_lex_alike(self):
+        for src in ['program p; var x: integer begin x := 1 end.',
+                    'program p; var caf\u00e9: integer begin end.',
+                    'program p; begin x := \u0663 end.',
+                    'program p; begin x := 1;\u00a0print(x) end.']:
+            results = []
+            for source in (src, src.encode()):
+                try:
+                    results.append(token_list(Tokenizer(source).tokenize()))
+                except ValueError:
+                    results.append(None)
+            self.assertEqual(results[0], results[1], src)
+
+    def test_parallel_lex_matches(self):
+        # chunks meet the names and numbers in other orders than the whole
+        stmts = ' '.join('v{0} := {1} + w{2}; w{2} := {0};'.format(
+            i % 7, i * 13 % 11, i * 5 % 9) for i in range(60))
+        src = 'program p; var x: integer begin {} end.'.format(stmts)
+        whole = Tokenizer(src).tokenize()
+        chunked = Tokenizer(src).tokenize_parallel(2, chunk_size=200)
+        self.assertEqual(token_list(chunked), token_list(whole))
+        self.assertEqual(chunked.names.names, whole.names.names)
+        self.assertEqual(chunked.constants.values, whole.constants.values)
+
+
+class AstArenaTest(unittest.TestCase):
+
+    def test_add_builds_what_add_tree_does(self):
+        # x: integer; x := 5 (+ 5), with the literal shared
+        literal = IntVal(5, constant=0, span=9 << SPAN_SHIFT | 10)
+        tree = Statements(None, [
+            BinOp(':', (0, 'integer'), 0 << SPAN_SHIFT | 10),
+            BinOp(':=', (Identifier(0, span=12 << SPAN_SHIFT | 13),
+                         BinOp('+', (literal, literal))))])
+        arena = AstArena()
+        declaration = arena.add(BinOp, ':', [-1 - arena.atom(0),
+                                             -1 - arena.atom('integer')],
+                                span=0 << SPAN_SHIFT | 10)
+        target = arena.add(Identifier, 0, span=12 << SPAN_SHIFT | 13)
+        value = arena.add(IntVal, 5, constant=0, span=9 << SPAN_SHIFT | 10)
+        total = arena.add(BinOp, '+', [value, value])
+        assign = arena.add(BinOp, ':=', [target, total])
+        arena.add(Statements, None, [declaration, assign])
+
+        reference = AstArena()
+        reference.add_tree(tree)
+        self.assertEqual(len(arena), len(reference))
+        self.assertEqual(list(arena.kinds), list(reference.kinds))
+        self.assertEqual(list(arena.constants), list(reference.constants))
+        self.assertEqual(list(arena.spans), list(reference.spans))
+        self.assertEqual(list(arena.firsts), list(reference.firsts))
+        for copy in (arena, AstArena.frombytes(arena.tobytes())):
+            rebuilt = copy.to_tree()
+            self.assertEqual(dump(rebuilt), dump(tree))
+            view = copy.view()
+            self.assertEqual(view.children[1].children[0].value, 0)
+            self.assertEqual(view.children[0].children, (0, 'integer'))
+            total = rebuilt.children[1].children[1]
+            self.assertIs(total.children[0], total.children[1])
+            self.assertEqual(total.children[0].constant, 0)
+            self.assertEqual(span_of(rebuilt.children[0]), (0, 10))
+
+    def test_round_trip_of_big_ints(self):
+        src = ('program p; var x: integer begin '
+               'x := 99999999999999999999 - 1; print(-9223372036854775808) '
+               'end.')
+        tree = Parser(src).run()
+        arena = AstArena()
+        arena.add_tree(tree)
+        copy = AstArena.frombytes(arena.tobytes()).to_tree()
+        self.assertEqual(dump(copy), dump(tree))
+
+    def test_round_trip_of_lazy_functions(self):
+        src = LazyFunctionsTest.src
+        parser = Parser(src, lazy_functions=True)
+        tree = parser.run()
+        arena = AstArena()
+        arena.add_tree(tree)
+        copy = AstArena.frombytes(arena.tobytes()).to_tree()
+        self.assertEqual(dump(copy), dump(Parser(src).run()))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ParseCache(directory)
+            cache.store(src, tree, parser.names)
+            self.assertEqual(dump(cache.load(src)[0]), dump(copy))
+
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ParseCache(directory.name)
+
+    def store(self, src):
+        parser = Parser(src)
+        self.cache.store(src, parser.run(), parser.names)
+        return self.cache.path(src)
+
+    def test_corrupted_entry_is_a_miss(self):
+        src = EvaluateTest.src
+        path = self.store(src)
+        with open(path, 'rb') as fin:
+            data = fin.read()
+        for size in range(len(data)):
+            with open(path, 'wb') as fout:
+                fout.write(data[:size])
+            self.assertIsNone(self.cache.load(src))
+        with open(path, 'wb') as fout:
+            fout.write(data[:-1] + b'\xff')
+        self.assertIsNone(self.cache.load(src))
+        os.remove(path)
+        self.assertIsNone(self.cache.load(src))
+
+    def test_str_and_bytes_sources_do_not_share_entries(self):
+        # spans are char offsets in one and byte offsets in the other
+        src = ('program p; var x: integer {' + '\u00e9' * 200 + '} '
+               'begin x := y end.')
+        self.store(src)
+        self.assertIsNone(self.cache.load(src.encode()))
+        parser = Parser(src.encode())
+        self.cache.store(src.encode(), parser.run(), parser.names)
+        tree = self.cache.load(src.encode())[0]
+        self.assertEqual(spans(tree), spans(Parser(src.encode()).run()))
+        self.assertEqual(spans(self.cache.load(src)[0]),
+                         spans(Parser(src).run()))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        srcs = ['program p; var x: integer begin x := {} end.'.format(i)
+                for i in range(11, 14)]
+        paths = [self.store(src) for src in srcs[:2]]
+        for age, path in enumerate(paths):
+            os.utime(path, (1000 + age, 1000 + age))
+        # a hit makes the older entry the most recently used
+        self.assertIsNotNone(self.cache.load(srcs[0]))
+        self.cache.max_size = sum(os.path.getsize(path) for path in paths)
+        self.store(srcs[2])
+        self.assertIsNone(self.cache.load(srcs[1]))
+        self.assertIsNotNone(self.cache.load(srcs[0]))
+        self.assertIsNotNone(self.cache.load(srcs[2]))
+
+
+class TokenBufferEditTest(unittest.TestCase):
+
+    src = 'program p; var x: integer begin x := 1 end.'
+
+    def test_edit_that_does_not_lex_is_kept(self):
+        buffer = Tokenizer(self.src).tokenize()
+        offset = self.src.index('1')
+        with self.assertRaises(ValueError):
+            buffer.edit(offset, 0, '}')
+        self.assertEqual(buffer.src, self.src[:offset] + '}' +
+                         self.src[offset:])
+        # deleting the stray } gives the original program back
+        buffer.edit(offset, 1, '')
+        self.assertEqual(buffer.src, self.src)
+        fresh = Tokenizer(self.src).tokenize()
+        self.assertEqual(token_list(buffer), token_list(fresh))
+
+    def test_scattered_edits(self):
+        src = 'program p; var x: integer begin {} end.'.format(
+            '; '.join('x := {}'.format(i) for i in range(10, 50)))
+        buffer = Tokenizer(src).tokenize()
+        # few breaks, so runs of tokens get rewritten to drop some
+        buffer.max_breaks = 3
+        for i in range(30):
+            offset = src.index(str(10 + (i * 7) % 40))
+            inserted = '1' * (i % 3)
+            buffer.edit(offset, 1, inserted)
+            src = src[:offset] + inserted + src[offset + 1:]
+            self.assertLessEqual(len(buffer.breaks), 3)
+            fresh = Tokenizer(src).tokenize()
+            self.assertEqual([token[:3] for token in token_list(buffer)],
+                             [token[:3] for token in token_list(fresh)])
+        buffer.normalize()
+        self.assertEqual(list(buffer.starts),
+                         [buffer.start(i) for i in range(len(buffer))])
+
+
+class IncrementalParserTest(unittest.TestCase):
+
+    src = ('program p; var x: integer begin x := 1; '
+           'while x < 3 do begin x := x + 1 end; print(x) end.')
+
+    def test_edit_that_does_not_lex(self):
+        parser = IncrementalParser(self.src)
+        parser.run()
+        offset = self.src.index('3')
+        with self.assertRaises(ValueError):
+            parser.edit(offset, 0, '}')
+        tree = parser.edit(offset, 1, '')
+        self.assertEqual(parser.buffer.src, self.src)
+        self.assertEqual(dump(tree), dump(Parser(self.src).run()))
+
+    def test_update_spans_reparses_when_the_walk_would_cost_more(self):
+        src = 'program p; var x: integer begin {} end.'.format(
+            '; '.join('x := {}'.format(i) for i in range(10, 40)))
+        # eight numbers edited, at the start or at the end of the body
+        for first, reparsed in (src.index('10'), True), (src.index('32'),
+                                                         False):
+            parser = IncrementalParser(src)
+            parser.run()
+            for i in range(8):
+                parser.edit(first + i * 9, 1, '7')
+            with mock.patch.object(parser, 'reparse_all',
+                                   wraps=parser.reparse_all) as reparse:
+                tree = parser.update_spans()
+            self.assertEqual(reparse.called, reparsed)
+            self.assertEqual(spans(tree),
+                             spans(Parser(parser.buffer.src).run()))
+
+    def test_spans_after_edits(self):
+        # a few edits are moved across, many make update_spans reparse
+        for count in (1, 3, 20):
+            parser = IncrementalParser(self.src)
+            parser.run()
+            src = self.src
+            for i in range(count):
+                offset = src.index('3')
+                parser.edit(offset, 0, '1')
+                src = src[:offset] + '1' + src[offset:]
+                offset = src.index('x + ') + 4
+                parser.edit(offset, 1, str(i % 10))
+                src = src[:offset] + str(i % 10) + src[offset + 1:]
+            tree = parser.update_spans()
+            self.assertEqual(spans(tree), spans(Parser(src).run()))
+
+
+if __name__ == '__main__':
+    unittest.main()